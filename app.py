@@ -6,21 +6,31 @@ Usage:
     # Opens at http://localhost:5000
 """
 
+import functools
+import gzip
+import hashlib
+import math
 import os
+import re
 import time
-import threading
 from datetime import datetime, timezone, timedelta
 from urllib.parse import urlencode
 from flask import (Flask, render_template, request, g, jsonify, send_file,
                    redirect, make_response)
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.http import is_resource_modified
+import compress
 import db
+import ratelimit
 import stats
+from cache import DiskCache, LRUCache
 
 PST = timezone(timedelta(hours=-8))
+# The public origin, for pages rendered outside a real request (warm,
+# prerender.py).
+SITE_URL = "https://campdex.com"
 
-# Simple in-memory rate limiter for API endpoints
-_rate_lock = threading.Lock()
-_rate_buckets = {}  # ip -> [timestamps]
+# Rate limiter for API endpoints (ratelimit.py): a sliding window per IP.
 # The limit is per IP, but the API's main consumer is AI assistants, and those
 # call from a platform's shared egress -- every user of a ChatGPT custom GPT or
 # a Claude integration lands on the same handful of addresses. At 60/min a few
@@ -32,30 +42,17 @@ _rate_buckets = {}  # ip -> [timestamps]
 # limiter exists to stop accidental hammering degrading the site, not to guard
 # the data -- the whole database is a public download, and bulk users should
 # take that instead of looping over the API.
+#
+# Counted per worker unless FEDCAMP_RATELIMIT_DB names a shared file, in
+# which case the limit holds across all of them.
 API_RATE_LIMIT = 300  # requests per window
 API_RATE_WINDOW = 60   # seconds
+_rate_limiter = ratelimit.from_env(API_RATE_LIMIT, API_RATE_WINDOW)
 
 
 def _check_rate_limit(ip):
-    """Return (allowed, remaining, retry_after). Prunes stale entries."""
-    now = time.monotonic()
-    cutoff = now - API_RATE_WINDOW
-    with _rate_lock:
-        hits = _rate_buckets.get(ip, [])
-        hits = [t for t in hits if t > cutoff]
-        if len(hits) >= API_RATE_LIMIT:
-            retry = hits[0] - cutoff
-            _rate_buckets[ip] = hits
-            return False, 0, retry
-        hits.append(now)
-        _rate_buckets[ip] = hits
-        # Prune stale IPs periodically (keep dict from growing unbounded)
-        if len(_rate_buckets) > 5000:
-            stale = [k for k, v in _rate_buckets.items()
-                     if not v or v[-1] < cutoff]
-            for k in stale:
-                del _rate_buckets[k]
-        return True, API_RATE_LIMIT - len(hits), 0
+    """Return (allowed, remaining, retry_after)."""
+    return _rate_limiter.hit(ip)
 
 
 def _client_ip():
@@ -103,6 +100,24 @@ WINTER_MONTHS = {11, 12, 1, 2, 3, 4}  # Nov–Apr
 
 app = Flask(__name__)
 
+# Compiled templates, kept on disk so a restarted worker loads bytecode
+# instead of parsing and compiling facility.html and friends again. Jinja
+# keys each file by template name and a hash of its source, so an edited
+# template is simply a miss. An unwritable directory means no cache, never
+# a failed render.
+TEMPLATE_CACHE_DIR = os.environ.get(
+    "FEDCAMP_TEMPLATE_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "template_cache"))
+try:
+    os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+except OSError:
+    pass
+if os.access(TEMPLATE_CACHE_DIR, os.W_OK):
+    app.jinja_options = {
+        **app.jinja_options,
+        "bytecode_cache": FileSystemBytecodeCache(TEMPLATE_CACHE_DIR),
+    }
+
 
 @app.after_request
 def set_security_headers(response):
@@ -230,10 +245,29 @@ def inject_filter_options():
     }
 
 
+_PIN_TILE_PATH = re.compile(r"^/api/pins/\d+/\d+/\d+$")
+
+
+def _rate_limited_path():
+    """Whether this request counts against the API rate limit.
+
+    Unfiltered pin tiles don't: one map view is dozens of them, nearly all
+    answered by the browser, the edge or the stored tiles. A filtered tile
+    does -- any filter combination renders live and takes a place in the
+    shared response cache, so exempting those would let one client render
+    without limit.
+    """
+    if not request.path.startswith("/api/"):
+        return False
+    if _PIN_TILE_PATH.match(request.path):
+        return _pins_key(None, _pin_filters()) != _DEFAULT_PINS_KEY
+    return True
+
+
 @app.before_request
 def before_request():
-    # Rate-limit API endpoints (60 req/min per IP)
-    if request.path.startswith("/api/"):
+    # Rate-limit API endpoints (API_RATE_LIMIT per window per IP).
+    if _rate_limited_path():
         ip = _client_ip()
         allowed, remaining, retry_after = _check_rate_limit(ip)
         if not allowed:
@@ -241,22 +275,80 @@ def before_request():
             resp.status_code = 429
             resp.headers["Retry-After"] = str(int(retry_after) + 1)
             return resp
+    # Pooled per thread and reused across requests -- never closed here.
     g.conn = db.get_connection()
 
 
-@app.teardown_request
-def teardown_request(exception):
-    conn = getattr(g, "conn", None)
-    if conn:
-        conn.close()
+# Pages and API responses built from the database change only when
+# deploy.sh --db swaps it in, when a deploy ships new code -- and, where
+# "likely open" is shown, when the month turns. Without caching headers
+# Cloudflare sent every one of them to the origin. Browsers keep them five
+# minutes; the edge a day, after which it revalidates and gets a 304. A
+# month rollover, a new build or a new release reaches the edge within
+# that day.
+DATA_CACHE_CONTROL = "public, max-age=300, s-maxage=86400"
+
+
+def _data_version():
+    """<build>-<YYYYMM>: what a data-derived response depends on."""
+    return f"{db.build_id(g.conn)}-{datetime.now(PST):%Y%m}"
+
+
+def _data_validators():
+    """(etag, last_modified) for the current build, month and code.
+
+    Weak, because one validator covers the identity and compressed bodies
+    alike. The code is in both: a code-only deploy changes the markup (and
+    which map.js it points at) without touching the build. Last-Modified is
+    the latest of the build, the start of the month and the release.
+    """
+    now = datetime.now(PST)
+    version, released = _release()
+    etag = f"{_data_version()}-{version}"
+    month_start = datetime(now.year, now.month, 1, tzinfo=PST)
+    built = db.build_time(g.conn)
+    return etag, max(t for t in (built, month_start, released) if t)
+
+
+def data_response(*vary):
+    """Decorator: cache a GET that depends only on its URL, the database
+    build and the month -- plus the request headers named in vary.
+
+    A conditional request that still matches is answered 304 before the
+    view runs, so no query does either (db.build_id is cached per database
+    generation). Only 200s get the caching headers; a 404 for a facility
+    that a later build might add stays uncached.
+    """
+    vary = ", ".join(("Accept-Encoding",) + vary)
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            etag, last_modified = _data_validators()
+            if not is_resource_modified(request.environ, etag=etag,
+                                        last_modified=last_modified):
+                resp = app.response_class(status=304)
+            else:
+                resp = make_response(view(*args, **kwargs))
+                if resp.status_code != 200:
+                    return resp
+            resp.set_etag(etag, weak=True)
+            resp.last_modified = last_modified
+            resp.headers["Cache-Control"] = DATA_CACHE_CONTROL
+            resp.headers["Vary"] = vary
+            return resp
+        return wrapper
+    return decorator
 
 
 @app.route("/")
+@data_response()
 def index():
-    return render_template("map.html")
+    return render_template("map.html", pins_build=tile_version(g.conn))
 
 
 @app.route("/search-form")
+@data_response()
 def search_form():
     states = db.get_states(g.conn)
     return render_template("index.html",
@@ -270,8 +362,39 @@ def search_form():
                            fire_options=FIRE_OPTIONS)
 
 
+# Rendered htmx result fragments. Filter chips and Load More re-request the
+# same few searches over and over; the rendered cards are kept compressed,
+# with their total, under the normalized query string and the build, month
+# and code they were rendered from. Normalizing sorts by parameter name only:
+# the order of a repeated parameter's values shows in the page ("States: OR,
+# WA"), and an empty value isn't an absent one (camping_type= matches
+# nothing). Bounded by bytes like the response cache.
+_fragment_cache = db.register_cache(
+    LRUCache(maxsize=4096, maxbytes=16 * 1024 * 1024,
+             sizeof=lambda item: item[0].size))
+
+
+def _fragment_key():
+    args = tuple(sorted(request.args.items(multi=True), key=lambda kv: kv[0]))
+    return _data_version(), _code_version(), args
+
+
+def _fragment_response(entry, total):
+    resp = _encoded_response(entry, DATA_CACHE_CONTROL, mimetype="text/html")
+    resp.headers["X-Total-Count"] = str(total)
+    return resp
+
+
 @app.route("/search")
+@data_response("HX-Request")
 def search():
+    htmx = bool(request.headers.get("HX-Request"))
+    if htmx:
+        fragment_key = _fragment_key()
+        hit = _fragment_cache.get(fragment_key)
+        if hit is not None:
+            return _fragment_response(*hit)
+
     states = [s.strip() for s in request.args.getlist("state") if s.strip()]
     lat = request.args.get("lat", type=float)
     lon = request.args.get("lon", type=float)
@@ -293,6 +416,11 @@ def search():
     reservable = 1 if request.args.get("reservable", type=int) == 1 else None
     rv_length = request.args.get("rv_length", type=int)
     page = request.args.get("page", 1, type=int)
+    # Load More carries both: `cursor` to seek straight to the next page,
+    # `page` so has_more can still be computed against the total. A cursor
+    # that doesn't decode (hand-edited URL, old bookmark) falls back to the
+    # page offset rather than failing the request.
+    cursor = request.args.get("cursor") or None
     view = request.args.get("view", "list")
 
     # The map view is the home page now; a state/point search can't be
@@ -304,6 +432,7 @@ def search():
         ct = list(db.DEFAULT_CAMPING_TYPES)
 
     offset = (page - 1) * 25
+    query_offset = 0 if cursor else offset
 
     # Bbox mode activates only when all four bounds are present
     bbox_active = None not in (south, north, west, east)
@@ -324,27 +453,30 @@ def search():
         excludes=_parse_excludes(),
     )
 
-    # Precedence: bbox > lat/lon > state
+    def page_of(search, *args, **kwargs):
+        try:
+            return search(g.conn, *args, limit=25, offset=query_offset,
+                          cursor=cursor, **kwargs, **filter_kwargs)
+        except db.InvalidCursor:
+            return search(g.conn, *args, limit=25, offset=offset,
+                          **kwargs, **filter_kwargs)
+
+    # Precedence: bbox > lat/lon > state. The state and radius searches
+    # return their total from the same statement (or the totals cache); the
+    # bbox count comes from the in-process index and costs microseconds.
+    by_distance = False
     if bbox_active:
-        results = db.search_by_bounds(
-            g.conn, south, north, west, east,
-            limit=25, offset=offset, **filter_kwargs)
+        results = page_of(db.search_by_bounds, south, north, west, east)
         total = db.get_bounds_count(
             g.conn, south, north, west, east, **filter_kwargs)
         search_desc = "In map area"
     elif lat is not None and lon is not None:
-        results = db.search_by_location(
-            g.conn, lat, lon, radius,
-            limit=25, offset=offset, **filter_kwargs)
-        total = db.get_search_count(
-            g.conn, lat=lat, lon=lon, radius_miles=radius, **filter_kwargs)
+        by_distance = True
+        results, total = page_of(db.search_by_location, lat, lon, radius,
+                                 with_total=True)
         search_desc = f"Within {int(radius)} miles of {lat:.2f}, {lon:.2f}"
     elif states:
-        results = db.search_by_state(
-            g.conn, states,
-            limit=25, offset=offset, **filter_kwargs)
-        total = db.get_search_count(
-            g.conn, state_codes=states, **filter_kwargs)
+        results, total = page_of(db.search_by_state, states, with_total=True)
         search_desc = "States: " + ", ".join(states) if len(states) > 1 else f"State: {states[0]}"
     else:
         results = []
@@ -358,9 +490,14 @@ def search():
     # for page 2 already carries page=2, so appending would build
     # "?page=2&page=3", and request.args.get("page") reads the first value —
     # pinning Load More on page 2 forever.
+    # The same goes for `cursor`.
     next_args = request.args.to_dict(flat=False)
     next_args.pop("page", None)
+    next_args.pop("cursor", None)
     next_args["page"] = [page + 1]
+    token = db.next_cursor(results, by_distance=by_distance)
+    if token:
+        next_args["cursor"] = [token]
     next_page_url = "/search?" + urlencode(next_args, doseq=True)
 
     ctx = dict(
@@ -393,21 +530,104 @@ def search():
     )
 
     # htmx partial
-    if request.headers.get("HX-Request"):
-        resp = make_response(render_template("_results_cards.html", **ctx))
-    else:
-        resp = make_response(render_template("results.html", **ctx))
+    if htmx:
+        entry = compress.EncodedBody(
+            render_template("_results_cards.html", **ctx).encode())
+        _fragment_cache.put(fragment_key, (entry, total))
+        return _fragment_response(entry, total)
+    resp = make_response(render_template("results.html", **ctx))
     # True unpaginated total on every /search response, so the front-end
     # can read the count without parsing HTML.
     resp.headers["X-Total-Count"] = str(total)
     return resp
 
 
-@app.route("/facility/<facility_id>")
-def facility(facility_id):
+# Rendered facility pages. These ~6,900 pages are the whole search-engine
+# surface and crawlers fetch them constantly, each one four queries, a
+# nearby search and a large template. The HTML is kept compressed, in
+# memory per worker and on disk shared by both workers, so a restart
+# doesn't mean re-rendering the crawl from cold. Keyed by build and month
+# (what the page shows) and by the code that renders it, so neither a
+# data nor a code deploy can serve a stale page.
+PAGE_CACHE_DIR = os.environ.get(
+    "FEDCAMP_PAGE_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "page_cache"))
+_page_cache = db.register_cache(
+    LRUCache(maxsize=8192, maxbytes=48 * 1024 * 1024,
+             sizeof=lambda entry: entry.size))
+_page_store = DiskCache(PAGE_CACHE_DIR)
+_release_value = None
+
+
+def _release():
+    """(fingerprint, released): the code this process runs, and when it
+    was put in place.
+
+    The fingerprint covers every module beside app.py, the templates and
+    the static files. All the modules, not just app.py: db.py decides what
+    a facility page and its nearby list contain, compress.py how a cached
+    body is encoded. It is mtime-based like static_v, and read once per
+    process for the same reason: gunicorn restarts on every deploy.
+
+    released is the newest ctime among those files. tar keeps a file's
+    mtime but can't set its ctime, so that is when deploy.sh extracted the
+    release.
+    """
+    global _release_value
+    if _release_value is None:
+        h = hashlib.blake2b(digest_size=6)
+        paths = [os.path.join(app.root_path, f)
+                 for f in os.listdir(app.root_path) if f.endswith(".py")]
+        for folder in (app.template_folder, app.static_folder):
+            for dirpath, _, files in os.walk(os.path.join(app.root_path, folder)):
+                paths += [os.path.join(dirpath, f) for f in files]
+        changed = 0
+        for path in sorted(paths):
+            st = os.stat(path)
+            h.update(f"{path}:{st.st_mtime_ns}\n".encode())
+            changed = max(changed, st.st_ctime)
+        _release_value = (h.hexdigest(),
+                          datetime.fromtimestamp(int(changed), timezone.utc))
+    return _release_value
+
+
+def _code_version():
+    """Fingerprint of the code (see _release)."""
+    return _release()[0]
+
+
+def _cached_page(name, render):
+    """EncodedBody of a rendered page, or None if render() returns None.
+
+    Memory first, then disk (stored gzipped), then render() -- which must
+    not depend on anything but the page's path, the data and the month.
+    """
+    namespace = f"{_data_version()}-{_code_version()}"
+    filename = f"{name}.html.gz"
+    entry = _page_cache.get((namespace, name))
+    if entry is not None:
+        return entry
+    stored = _page_store.get(namespace, filename)
+    if stored is not None:
+        try:
+            entry = compress.EncodedBody(gzip.decompress(stored), stored)
+        except (OSError, EOFError):
+            entry = None    # truncated or corrupt; render it again
+    if entry is None:
+        html = render()
+        if html is None:
+            return None
+        entry = compress.EncodedBody(html.encode())
+        if "gzip" in entry.variants:
+            _page_store.put(namespace, filename, entry.variants["gzip"])
+    _page_cache.put((namespace, name), entry)
+    return entry
+
+
+def _render_facility(facility_id):
     data = db.get_facility(g.conn, facility_id)
     if not data:
-        return render_template("404.html"), 404
+        return None
 
     nearby = db.get_nearby(
         g.conn, facility_id,
@@ -416,6 +636,16 @@ def facility(facility_id):
     return render_template("facility.html", f=data, nearby=nearby)
 
 
+@app.route("/facility/<facility_id>")
+@data_response()
+def facility(facility_id):
+    entry = _cached_page(f"facility-{facility_id}",
+                         lambda: _render_facility(facility_id))
+    if entry is None:
+        return render_template("404.html"), 404
+    return _encoded_response(entry, DATA_CACHE_CONTROL, mimetype="text/html")
+
+
 @app.route("/map")
 def map_view():
     """Redirect /map to / (map is now the home page)."""
@@ -423,15 +653,68 @@ def map_view():
     return redirect(url_for("index"))
 
 
-@app.route("/api/pins")
-def api_pins():
-    south = request.args.get("south", type=float)
-    north = request.args.get("north", type=float)
-    west = request.args.get("west", type=float)
-    east = request.args.get("east", type=float)
-    if None in (south, north, west, east):
-        return jsonify({"error": "south, north, west, east required"}), 400
-
+# Response cache for /api/pins, the pin tiles and /api/states. The map asks
+# for pins on every refresh, and a zoomed-out view is thousands of pins --
+# ~1.5MB of JSON to build and serialize. The viewport is snapped outward to
+# a grid (below), so nearby pans and different visitors looking at the same
+# region ask for the same box; the serialized bytes are cached under (box,
+# filters), already compressed, with a content-hash ETag
+# (compress.EncodedBody). Bounded by bytes, not entries, because one
+# continental view outweighs hundreds of city views. Emptied when the
+# database changes (db.register_cache).
+_response_cache = db.register_cache(
+    LRUCache(maxsize=1024, ttl=3600, maxbytes=64 * 1024 * 1024,
+             sizeof=lambda entry: entry.size))
+
+# Finest grid cell: 360 / 2**20 degrees, about 4cm.
+PIN_GRID_MIN_CELL = 360.0 / 2 ** 20
+
+
+def _snap_bounds(south, north, west, east):
+    """Round a viewport outward onto the /api/pins cache grid.
+
+    Cells are 360 / 2**k degrees, the largest that still fits 8 across the
+    box's longer side. Snapping widens the box, which can call for a coarser
+    cell, so it repeats until the box is a fixed point: a snapped box snaps
+    to itself, which lets the map send snapped bounds and hit the same key.
+    Typical viewports gain about a third in area. static/map.js (snapBounds)
+    must do exactly the same arithmetic.
+    """
+    box = (south, north, west, east)
+    if not all(math.isfinite(v) for v in box):
+        return box
+    for _ in range(16):
+        s, n, w, e = box
+        span = max(n - s, e - w)
+        cell = 360.0
+        while cell > span / 8 and cell > PIN_GRID_MIN_CELL:
+            cell /= 2
+        snapped = (math.floor(s / cell) * cell, math.ceil(n / cell) * cell,
+                   math.floor(w / cell) * cell, math.ceil(e / cell) * cell)
+        if snapped == box:
+            break
+        box = snapped
+    return box
+
+
+def _pins_key(bounds, filters):
+    """Cache key for a pins request: equal for requests matching the same pins."""
+    def norm(values):
+        return tuple(sorted(set(values))) if values else None
+
+    key = [bounds, norm(filters["camping_types"] or db.DEFAULT_CAMPING_TYPES)]
+    for name in ("agencies", "road_access", "seasonal_status", "fire_status",
+                 "styles", "hookups", "tag_filters"):
+        key.append(norm(filters[name]))
+    key.append(1 if filters["reservable"] else None)
+    key.append(filters["min_rv_length"] or None)
+    key.append(tuple(sorted((k, norm(v))
+                            for k, v in filters["excludes"].items())))
+    return tuple(key)
+
+
+def _pin_filters():
+    """The map's filter params, as keyword arguments for the db pin queries."""
     ct = request.args.getlist("camping_type") or None
     agencies = request.args.getlist("agency") or None
     road_access = request.args.getlist("road_access") or None
@@ -447,18 +730,157 @@ def api_pins():
     if min_rv is None:
         min_rv = request.args.get("rv_length", type=int)
 
-    pins = db.search_pins_by_bounds(
-        g.conn, south, north, west, east,
+    return dict(
         camping_types=ct, agencies=agencies,
         road_access=road_access, seasonal_status=seasonal,
         fire_status=fire, styles=styles,
         hookups=hookups, reservable=reservable,
         tag_filters=tags, min_rv_length=min_rv,
         excludes=_parse_excludes())
-    return jsonify(pins)
+
+
+def _cached_body(key, render):
+    """EncodedBody for key from the response cache, calling render() on a miss.
+
+    render returns the JSON bytes (db.dump_json), so the prerendered tiles
+    and the live ones are byte-identical and share ETags. Compression
+    happens here, once per entry.
+    """
+    entry = _response_cache.get(key)
+    if entry is None:
+        entry = compress.EncodedBody(render())
+        _response_cache.put(key, entry)
+    return entry
+
+
+def _encoded_response(entry, cache_control, mimetype="application/json"):
+    """Serve a compress.EncodedBody in the encoding the client prefers."""
+    coding, body, etag = entry.select(request.headers.get("Accept-Encoding"))
+    resp = app.response_class(body, mimetype=mimetype)
+    if coding:
+        resp.headers["Content-Encoding"] = coding
+    resp.headers["Vary"] = "Accept-Encoding"
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = cache_control
+    return resp.make_conditional(request)
+
+
+def _streamed_json(obj):
+    """JSON response encoded and compressed in chunks (compress.stream_json).
+
+    For uncached responses: nothing is kept, so there's no reason to build
+    the whole body -- and then a compressed copy of it -- before sending.
+    """
+    coding = compress.negotiate(request.headers.get("Accept-Encoding"),
+                                compress.STREAM_CODINGS)
+    resp = app.response_class(compress.stream_json(obj, coding),
+                              mimetype="application/json")
+    if coding != "identity":
+        resp.headers["Content-Encoding"] = coding
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+
+
+def _request_bounds():
+    """(south, north, west, east) from the query string, or None if incomplete."""
+    bounds = tuple(request.args.get(k, type=float)
+                   for k in ("south", "north", "west", "east"))
+    return None if None in bounds else bounds
+
+
+@app.route("/api/pins")
+def api_pins():
+    bounds = _request_bounds()
+    if bounds is None:
+        return jsonify({"error": "south, north, west, east required"}), 400
+    # Pins for the snapped box: a superset of the viewport, never a subset.
+    bounds = _snap_bounds(*bounds)
+
+    filters = _pin_filters()
+    # format=columns: parallel arrays, several times smaller (db.pins_to_columns)
+    columns = request.args.get("format") == "columns"
+
+    def render():
+        pins = db.search_pins_by_bounds(g.conn, *bounds, **filters)
+        return db.dump_json(db.pins_to_columns(pins) if columns else pins)
+
+    entry = _cached_body((columns,) + _pins_key(bounds, filters), render)
+    # Stored, but revalidated on every use: a repeat pan costs a 304.
+    return _encoded_response(entry, "no-cache")
+
+
+@app.route("/api/pins/count")
+@data_response()
+def api_pins_count():
+    """How many pins a viewport holds, exactly -- for when the map shows
+    tiles, whose clusters can't be counted against the viewport edge."""
+    bounds = _request_bounds()
+    if bounds is None:
+        return jsonify({"error": "south, north, west, east required"}), 400
+    return jsonify({"count": db.get_bounds_count(g.conn, *bounds,
+                                                 **_pin_filters())})
+
+
+def tile_version(conn):
+    """<build>-<code>: the version in every tile URL.
+
+    The database decides which pins a tile holds; the code decides the
+    cluster cells, the payload and the format. A change to either has to
+    be a new set of URLs, since tiles are cached for a year.
+    """
+    return f"{db.build_id(conn)}-{_code_version()}"
+
+
+def _pin_tile_response(build, z, x, y, filters):
+    """One XYZ tile of map pins, server-clustered at low zoom (db.get_pin_tile).
+
+    Tile URLs carry the tile version (tile_version, from the map page).
+    With the current one the response is immutable -- a new build or
+    release is new URLs -- so browsers and the edge keep it for a year.
+    Without it, or with a stale one, it's only cacheable briefly.
+    """
+    if z > db.TILE_MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        return jsonify({"error": "no such tile"}), 404
+
+    def render():
+        if _pins_key(None, filters) == _DEFAULT_PINS_KEY:
+            body = db.prerendered_tile(g.conn, z, x, y)
+            if body is not None:
+                return body
+        return db.dump_json(db.get_pin_tile(g.conn, z, x, y, **filters))
+
+    entry = _cached_body(("tile", z, x, y) + _pins_key(None, filters), render)
+    if build == tile_version(g.conn):
+        cache_control = "public, max-age=31536000, immutable"
+    else:
+        cache_control = "public, max-age=300"
+    return _encoded_response(entry, cache_control)
+
+
+@app.route("/api/pins/<int:z>/<int:x>/<int:y>")
+def api_pin_tile(z, x, y):
+    return _pin_tile_response(request.args.get("b"), z, x, y, _pin_filters())
+
+
+# What _pin_filters() returns for a request with no filter params.
+_DEFAULT_PIN_FILTERS = dict(
+    camping_types=None, agencies=None, road_access=None,
+    seasonal_status=None, fire_status=None, styles=None, hookups=None,
+    reservable=None, tag_filters=None, min_rv_length=None, excludes={})
+_DEFAULT_PINS_KEY = _pins_key(None, _DEFAULT_PIN_FILTERS)
+
+
+@app.route("/tiles/<version>/<int:z>/<int:x>/<int:y>.json")
+def pin_tile_static(version, z, x, y):
+    """The unfiltered map's tiles at a plain path, prerendered by
+    prepare_db.py. Caddy serves export_tiles.py's copies of these from disk
+    and only falls through to here for tiles it doesn't have (the empty
+    ones, or a version that hasn't been exported)."""
+    return _pin_tile_response(version, z, x, y, _DEFAULT_PIN_FILTERS)
 
 
 @app.route("/api/search")
+@data_response()
 def api_search():
     states = [s.strip() for s in request.args.getlist("state") if s.strip()]
     lat = request.args.get("lat", type=float)
@@ -476,6 +898,10 @@ def api_search():
     rv_length = request.args.get("rv_length", type=int)
     limit = min(request.args.get("limit", 25, type=int), 100)
     offset = request.args.get("offset", 0, type=int)
+    # Keyset pagination: pass back the previous response's next_cursor.
+    # `offset` keeps working for existing clients (and applies after the
+    # cursor if both are sent).
+    cursor = request.args.get("cursor") or None
 
     if not ct:
         ct = list(db.DEFAULT_CAMPING_TYPES)
@@ -492,35 +918,96 @@ def api_search():
         excludes=_parse_excludes(),
     )
 
-    if lat is not None and lon is not None:
-        results = db.search_by_location(
-            g.conn, lat, lon, radius,
-            limit=limit, offset=offset, **filter_kwargs)
-        total = db.get_search_count(
-            g.conn, lat=lat, lon=lon, radius_miles=radius, **filter_kwargs)
-    elif states:
-        results = db.search_by_state(
-            g.conn, states,
-            limit=limit, offset=offset, **filter_kwargs)
-        total = db.get_search_count(
-            g.conn, state_codes=states, **filter_kwargs)
-    else:
-        return jsonify({"error": "state or lat/lon required"}), 400
-
-    return jsonify({"total": total, "results": results})
+    try:
+        if lat is not None and lon is not None:
+            by_distance = True
+            results, total = db.search_by_location(
+                g.conn, lat, lon, radius, limit=limit, offset=offset,
+                cursor=cursor, with_total=True, **filter_kwargs)
+        elif states:
+            by_distance = False
+            results, total = db.search_by_state(
+                g.conn, states, limit=limit, offset=offset,
+                cursor=cursor, with_total=True, **filter_kwargs)
+        else:
+            return jsonify({"error": "state or lat/lon required"}), 400
+    except db.InvalidCursor:
+        return jsonify({"error": "invalid cursor"}), 400
+
+    # A short page is the last one. A full page gets a cursor even when it
+    # happens to end exactly at the total; the next call returns no results
+    # and a null next_cursor.
+    next_token = (db.next_cursor(results, by_distance=by_distance)
+                  if len(results) == limit else None)
+    return _streamed_json({"total": total, "results": results,
+                           "next_cursor": next_token})
 
 
 @app.route("/api/facility/<facility_id>")
+@data_response()
 def api_facility(facility_id):
     data = db.get_facility(g.conn, facility_id)
     if not data:
         return jsonify({"error": "facility not found"}), 404
-    return jsonify(data)
+    return _streamed_json(data)
+
+
+# Most ids /api/facilities takes at once: four pages of search results.
+FACILITIES_MAX_IDS = 100
+
+
+@app.route("/api/facilities")
+@data_response()
+def api_facilities():
+    """Full detail for many facilities in one call (db.get_facilities).
+
+    Assistants hydrate a page of /api/search results this way instead of
+    calling /api/facility/<id> once per result -- one request against the
+    rate limit, and four queries instead of four per facility.
+    """
+    ids = [i.strip() for arg in request.args.getlist("ids")
+           for i in arg.split(",") if i.strip()]
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return jsonify({"error": "ids required"}), 400
+    if len(ids) > FACILITIES_MAX_IDS:
+        return jsonify({"error": f"at most {FACILITIES_MAX_IDS} ids"}), 400
+    found = db.get_facilities(g.conn, ids)
+    return _streamed_json({
+        "results": [found[i] for i in ids if i in found],
+        "not_found": [i for i in ids if i not in found],
+    })
+
+
+# /api/facility/<id>/nearby limits. Within db.NEARBY_K and
+# db.NEARBY_RADIUS_MILES the answer is a stored lookup; past them it's a
+# live search, still bounded by these.
+NEARBY_MAX_K = 50
+NEARBY_MAX_RADIUS = 250
+
+
+@app.route("/api/facility/<facility_id>/nearby")
+@data_response()
+def api_facility_nearby(facility_id):
+    k = max(1, min(request.args.get("k", 8, type=int), NEARBY_MAX_K))
+    radius = request.args.get("radius", 50, type=float)
+    if not (0 < radius < math.inf):
+        return jsonify({"error": "radius must be a positive number of miles"}), 400
+    radius = min(radius, NEARBY_MAX_RADIUS)
+    results = db.facility_nearby(g.conn, facility_id, radius, k)
+    if results is None:
+        return jsonify({"error": "facility not found"}), 404
+    return jsonify({"facility_id": facility_id, "radius_miles": radius,
+                    "results": results})
 
 
 @app.route("/api/states")
+@data_response()
 def api_states():
-    return jsonify(db.get_states(g.conn))
+    # Compressed once, like the pins; data_response supplies the validators.
+    entry = _cached_body(("states",),
+                         lambda: db.dump_json(db.get_states(g.conn)))
+    return _encoded_response(entry, DATA_CACHE_CONTROL)
 
 
 @app.route("/api/download")
@@ -550,6 +1037,7 @@ STATE_NAMES = {
 
 
 @app.route("/campgrounds")
+@data_response()
 def campgrounds_index():
     """State index — the entry point to the crawlable page graph.
 
@@ -566,6 +1054,7 @@ def campgrounds_index():
 
 
 @app.route("/campgrounds/<state_code>")
+@data_response()
 def campgrounds_state(state_code):
     code = state_code.upper()
     if code not in STATE_NAMES:
@@ -580,17 +1069,18 @@ def campgrounds_state(state_code):
 
 
 # The sitemap is ~6,900 URLs built from a query; rebuilding it per request
-# would be wasteful on a 2-vCPU box, and crawlers re-fetch it often.
-_sitemap_cache = {"xml": None, "ts": 0}
+# would be wasteful on a 2-vCPU box, and crawlers re-fetch it often. Kept
+# compressed (it's ~900KB of highly repetitive XML), and dropped with the
+# database it was built from.
+_sitemap_cache = db.register_cache({})
 SITEMAP_TTL = 86400
 
 
 @app.route("/sitemap.xml")
 def sitemap():
     now = time.time()
-    if _sitemap_cache["xml"] and (now - _sitemap_cache["ts"]) < SITEMAP_TTL:
-        xml = _sitemap_cache["xml"]
-    else:
+    entry = _sitemap_cache.get("body")
+    if entry is None or (now - _sitemap_cache["ts"]) >= SITEMAP_TTL:
         base = request.url_root.rstrip("/")
         parts = ['<?xml version="1.0" encoding="UTF-8"?>',
                  '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
@@ -609,16 +1099,13 @@ def sitemap():
         for fid in db.all_facility_ids(g.conn):
             url(f"/facility/{fid}", "0.6", "monthly")
         parts.append("</urlset>")
-        xml = "".join(parts)
-        _sitemap_cache["xml"] = xml
-        _sitemap_cache["ts"] = now
+        entry = compress.EncodedBody("".join(parts).encode())
+        _sitemap_cache.update(body=entry, ts=now)
 
-    resp = make_response(xml)
-    resp.headers["Content-Type"] = "application/xml"
     # An hour at the edge: long enough to spare the box, short enough that a
     # data refresh reaches crawlers the same day.
-    resp.headers["Cache-Control"] = "public, max-age=3600"
-    return resp
+    return _encoded_response(entry, "public, max-age=3600",
+                             mimetype="application/xml")
 
 
 # AI crawlers and assistants are welcome here: the site exists to make federal
@@ -722,7 +1209,11 @@ campgrounds, where positive filters discard them:
 - [Endpoints, parameters and a ready-made assistant prompt]({base}/about)
 - `{base}/api/states` — every state with a campground count
 - `{base}/api/search?state=XX` — search by state, or `?lat=&lon=&radius=`
+  (page with `cursor=` + the previous response's `next_cursor`)
 - `{base}/api/facility/<id>` — full detail for one campground
+- `{base}/api/facilities?ids=<id>,<id>,...` — full detail for up to 100 at once;
+  use this to hydrate a page of search results in one call
+- `{base}/api/facility/<id>/nearby?k=8&radius=50` — nearest campgrounds to it
 - 300 requests/minute per IP. Platforms share addresses, so that budget is
   shared across all users of your integration. A 429 carries Retry-After.
 
@@ -763,7 +1254,25 @@ def site_stats():
 
 
 # Template filters
+#
+# The string filters run for every card on every render -- the same ~7K
+# names and a few dozen enum values over and over -- and are pure, so each
+# is memoized with a bounded LRU. Sized to hold every facility name with
+# room for agencies and nearby lists. typed=True because Jinja passes both
+# str and Markup: they compare and hash equal, and without it whichever
+# came first would be returned for both -- escaped and unescaped swapped.
+
+# .title() mangles the acronyms this vocabulary is full of: 4WD_REQUIRED
+# became "4Wd Required", OHV became "Ohv".
+_TAG_WORD_FIXES = {
+    "4Wd": "4WD", "Rv": "RV", "Ohv": "OHV", "Atv": "ATV", "Blm": "BLM",
+    "Nps": "NPS", "Usfs": "USFS", "Usace": "USACE", "Fws": "FWS",
+    "Bor": "BOR", "Amp": "amp", "Ada": "ADA",
+}
+
+
 @app.template_filter("tag_display")
+@functools.lru_cache(maxsize=1024, typed=True)
 def tag_display(tag):
     """Human label for an enum value.
 
@@ -781,12 +1290,7 @@ def tag_display(tag):
     if tag == "UNKNOWN":
         return "Not recorded"
     words = tag.replace("_", " ").title().split()
-    # .title() mangles the acronyms this vocabulary is full of: 4WD_REQUIRED
-    # became "4Wd Required", OHV became "Ohv".
-    fixed = {"4Wd": "4WD", "Rv": "RV", "Ohv": "OHV", "Atv": "ATV",
-             "Blm": "BLM", "Nps": "NPS", "Usfs": "USFS", "Usace": "USACE",
-             "Fws": "FWS", "Bor": "BOR", "Amp": "amp", "Ada": "ADA"}
-    return " ".join(fixed.get(w, w) for w in words)
+    return " ".join(_TAG_WORD_FIXES.get(w, w) for w in words)
 
 
 # Acronyms / abbreviations to preserve when title-casing ALL-CAPS names
@@ -818,6 +1322,7 @@ _TITLE_KEEP_LOWER = {"a", "an", "and", "at", "by", "de", "del", "for", "in",
 
 
 @app.template_filter("smart_title")
+@functools.lru_cache(maxsize=16384, typed=True)
 def smart_title(name):
     """Title-case ALL-CAPS strings, preserving acronyms and state codes.
 
@@ -888,34 +1393,44 @@ def smart_title(name):
     return " ".join(fixed)
 
 
+# Condition pill colors. All backgrounds meet WCAG AA (>= 4.5:1) against
+# white pill text:
+#   #2d7d46 5.08:1, #6c757d 4.69:1, #a85a1e 5.06:1, #c0392b 5.44:1,
+#   #8a6d10 4.91:1, #7f1d1d 10.02:1, #5f6e6f 5.32:1
+_CONDITION_COLORS = {
+    # Road access
+    'PAVED': '#2d7d46', 'GRAVEL': '#6c757d', 'DIRT': '#a85a1e',
+    'HIGH_CLEARANCE': '#c0392b', '4WD_REQUIRED': '#c0392b',
+    # Seasonal
+    'OPEN_YEAR_ROUND': '#2d7d46', 'SEASONAL_CLOSURE': '#8a6d10',
+    'WINTER_CLOSURE': '#a85a1e',
+    'TEMPORARILY_CLOSED': '#c0392b', 'PERMANENTLY_CLOSED': '#7f1d1d',
+    # Fire
+    'CAMPFIRES_ALLOWED': '#2d7d46', 'RESTRICTIONS': '#8a6d10',
+    'NO_CAMPFIRES': '#c0392b',
+    # Boondock
+    'EASY': '#2d7d46', 'MODERATE': '#8a6d10', 'ROUGH': '#c0392b',
+    'UNKNOWN': '#5f6e6f',
+}
+
+
 @app.template_filter("condition_color")
 def condition_color(value):
     """Color for condition pills."""
-    # All backgrounds meet WCAG AA (>= 4.5:1) against white pill text:
-    #   #2d7d46 5.08:1, #6c757d 4.69:1, #a85a1e 5.06:1, #c0392b 5.44:1,
-    #   #8a6d10 4.91:1, #7f1d1d 10.02:1, #5f6e6f 5.32:1
-    colors = {
-        # Road access
-        'PAVED': '#2d7d46', 'GRAVEL': '#6c757d', 'DIRT': '#a85a1e',
-        'HIGH_CLEARANCE': '#c0392b', '4WD_REQUIRED': '#c0392b',
-        # Seasonal
-        'OPEN_YEAR_ROUND': '#2d7d46', 'SEASONAL_CLOSURE': '#8a6d10',
-        'WINTER_CLOSURE': '#a85a1e',
-        'TEMPORARILY_CLOSED': '#c0392b', 'PERMANENTLY_CLOSED': '#7f1d1d',
-        # Fire
-        'CAMPFIRES_ALLOWED': '#2d7d46', 'RESTRICTIONS': '#8a6d10',
-        'NO_CAMPFIRES': '#c0392b',
-        # Boondock
-        'EASY': '#2d7d46', 'MODERATE': '#8a6d10', 'ROUGH': '#c0392b',
-        'UNKNOWN': '#5f6e6f',
-    }
-    return colors.get(value, '#5f6e6f')
+    # A lookup in a module-level table, which is all a memo would be; the
+    # table used to be rebuilt on every call.
+    return _CONDITION_COLORS.get(value, '#5f6e6f')
 
 
 @app.template_filter("likely_open")
 def likely_open(seasonal_status):
     """Estimate if a campground is likely open right now based on PST month."""
-    month = datetime.now(PST).month
+    return _likely_open_in(seasonal_status, datetime.now(PST).month)
+
+
+@functools.lru_cache(maxsize=256)
+def _likely_open_in(seasonal_status, month):
+    # Keyed by month as well: the same status answers differently in winter.
     if seasonal_status == "OPEN_YEAR_ROUND":
         return True
     if seasonal_status in ("PERMANENTLY_CLOSED", "TEMPORARILY_CLOSED"):
@@ -925,5 +1440,53 @@ def likely_open(seasonal_status):
     return None  # UNKNOWN
 
 
+# Pages whose rendering warm() exercises: the sitemap and state index are
+# cached outright, and the rest compile the templates every request uses.
+_WARM_PATHS = ["/sitemap.xml", "/campgrounds", "/", "/about"]
+
+
+def warm():
+    """Fill this process's caches before it serves a request.
+
+    After a deploy every worker used to start cold: the first visitors paid
+    for the facility index, template compilation, the sitemap query and a
+    disk read of every SQLite page they touched. gunicorn.conf.py calls
+    this in the master with the app preloaded, so the workers fork with it
+    all done and share the memory copy-on-write. Returns a dict of timings
+    for the log.
+    """
+    timings = {}
+    t = time.perf_counter()
+    db.warm_file()
+    timings["file"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    conn = db.get_connection()
+    db.build_id(conn)
+    db.prerendered_tiles_current(conn)
+    db.facility_index(conn)
+    timings["index"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    for dirpath, _, files in os.walk(app.static_folder):
+        for name in files:
+            static_v(os.path.relpath(os.path.join(dirpath, name),
+                                     app.static_folder))
+    _code_version()
+    client = app.test_client()
+    paths = list(_WARM_PATHS)
+    states = db.get_states(conn)
+    if states:
+        code = states[0]["state_code"]
+        paths += [f"/campgrounds/{code}", f"/search?state={code}"]
+        facilities = db.facilities_for_state(conn, code)
+        if facilities:
+            paths.append(f"/facility/{facilities[0]['facility_id']}")
+    for path in paths:
+        client.get(path, base_url=SITE_URL)
+    timings["pages"] = time.perf_counter() - t
+    return timings
+
+
 if __name__ == "__main__":
     app.run(debug=os.environ.get("FLASK_DEBUG", "").lower() == "true", port=5000)
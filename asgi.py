@@ -0,0 +1,162 @@
+"""
+asgi.py — the Flask app as an ASGI application, for uvicorn or hypercorn
+
+Under gunicorn's sync workers a request holds its worker until the last byte
+is on the wire, so one visitor on a slow phone pulling a continental pins
+payload keeps a whole worker from serving anyone else. Here the event loop
+does the sending: the app runs on a bounded thread pool (each thread keeps
+its own pooled read-only connection, db.get_connection), and a thread is
+held only while a view runs or a streamed body produces its next chunk --
+never while a client is reading.
+
+Stdlib only: a small WSGI-to-ASGI bridge rather than asgiref, so the app
+itself gains no dependency. Only the server has to be installed:
+
+    pip install uvicorn
+    uvicorn asgi:app --host 127.0.0.1 --port 5001 --workers 2 --no-access-log
+
+    # or
+    pip install hypercorn
+    hypercorn asgi:app --bind 127.0.0.1:5001 --workers 2
+
+FEDCAMP_ASGI_THREADS sets the pool size (default 8 per worker process).
+See README, "Deployment", for running it beside gunicorn.
+"""
+
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import app as webapp
+from app import app as flask_app
+
+THREADS = int(os.environ.get("FEDCAMP_ASGI_THREADS", "8"))
+
+_executor = None
+_END = object()
+
+
+def _pool():
+    # Created on first use, in the serving process: a pool made before a
+    # server forks its workers would have no threads in them.
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=THREADS,
+                                       thread_name_prefix="asgi")
+    return _executor
+
+
+def _environ(scope, body):
+    """PEP 3333 environ for an ASGI http scope."""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+            continue
+        key = "HTTP_" + name
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _start(environ):
+    """Run the app up to its first body chunk. In a pool thread."""
+    started = {}
+    written = []
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and started.get("sent"):
+            raise exc_info[1].with_traceback(exc_info[2])
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1"))
+                              for k, v in headers]
+        return written.append
+
+    result = flask_app(environ, start_response)
+    chunks = iter(result)
+    first = next(chunks, _END)
+    started["sent"] = True
+    if written:
+        # The legacy write() callable: nothing in this app uses it.
+        first = b"".join(written) + (b"" if first is _END else first)
+    return started, result, chunks, first
+
+
+def _close(result):
+    close = getattr(result, "close", None)
+    if close is not None:
+        close()
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # Warm before accepting requests, as gunicorn.conf.py does --
+            # and, like it, start cold rather than not at all if that fails.
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    _pool(), webapp.warm)
+            except Exception:
+                webapp.app.logger.exception("warm failed; starting cold")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] != "http":
+        return      # no websockets here
+
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+
+    loop = asyncio.get_running_loop()
+    pool = _pool()
+    started, result, chunks, chunk = await loop.run_in_executor(
+        pool, _start, _environ(scope, body))
+    try:
+        await send({"type": "http.response.start",
+                    "status": started["status"],
+                    "headers": started["headers"]})
+        while chunk is not _END:
+            if chunk:
+                await send({"type": "http.response.body",
+                            "body": chunk, "more_body": True})
+            chunk = await loop.run_in_executor(pool, next, chunks, _END)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        await loop.run_in_executor(pool, _close, result)
@@ -0,0 +1,137 @@
+"""
+cache.py — small in-process LRU cache with optional expiry, and a disk store
+
+Shared by db.py and app.py for results that are expensive to compute and
+only change when the database does. Thread-safe: gunicorn runs sync workers
+today, but nothing here should depend on that.
+No Flask dependency (same pattern as db.py and stats.py).
+"""
+
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Mapping of at most `maxsize` entries, least recently used evicted first.
+
+    With `ttl` (seconds), entries also expire that long after being stored.
+    With `maxbytes`, the total `sizeof(value)` is capped too, so a cache of
+    response bodies is bounded by memory rather than count; a value larger
+    than the whole budget is not stored at all.
+    Values are returned as stored, not copied -- cache immutable things
+    (tuples, ints, bytes) or don't mutate what comes back.
+    """
+
+    def __init__(self, maxsize=256, ttl=None, maxbytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self._data = OrderedDict()   # key -> (stored_at, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            stored_at, value = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                self._discard(key)
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        with self._lock:
+            self._discard(key)
+            if self.maxbytes is not None and size > self.maxbytes:
+                return
+            self._data[key] = (time.monotonic(), value)
+            self._bytes += size
+            while len(self._data) > self.maxsize or (
+                    self.maxbytes is not None and self._bytes > self.maxbytes):
+                self._discard(next(iter(self._data)))
+
+    def _discard(self, key):
+        """Drop key if present. Caller holds the lock."""
+        entry = self._data.pop(key, None)
+        if entry is not None and self.maxbytes is not None:
+            self._bytes -= self.sizeof(entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class DiskCache:
+    """Bytes stored as files under root/<namespace>/<key>, shared by every
+    worker and surviving restarts.
+
+    One namespace is live at a time: the first write into a new one deletes
+    the others, so a new build's entries replace the old build's rather than
+    piling up. Writes go to a temp file and are renamed into place, so no
+    reader -- in this process or another -- sees a partial file. Keys must
+    be plain file names; anything else is a miss. Disk errors are misses
+    too: this is a cache, and not finding something is always safe.
+    """
+
+    _NAME = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]*")
+
+    def __init__(self, root):
+        self.root = root
+        self._live = None
+        self._lock = threading.Lock()
+
+    def _path(self, namespace, key):
+        if not (self._NAME.fullmatch(namespace) and self._NAME.fullmatch(key)):
+            return None
+        return os.path.join(self.root, namespace, key)
+
+    def get(self, namespace, key):
+        path = self._path(namespace, key)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, namespace, key, value):
+        path = self._path(namespace, key)
+        if path is None:
+            return
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            if self._live != namespace:
+                self._switch(namespace)
+            with open(tmp, "wb") as f:
+                f.write(value)
+            os.replace(tmp, path)
+        except OSError:
+            # Most likely another worker switched namespaces underneath us.
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def _switch(self, namespace):
+        with self._lock:
+            os.makedirs(os.path.join(self.root, namespace), exist_ok=True)
+            for name in os.listdir(self.root):
+                if name != namespace:
+                    shutil.rmtree(os.path.join(self.root, name),
+                                  ignore_errors=True)
+            self._live = namespace
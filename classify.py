@@ -5,6 +5,8 @@ Reads n_facility_rollup and produces:
   - n_facility_conditions: practical condition indicators per facility
     (road access, seasonal status, fire status, elevation, etc.)
   - n_facility_tags: feature tags/badges per facility
+    (also packed into n_facility_conditions.tag_mask, one bit per tag in
+    db.TAG_VOCABULARY)
 
 Replaces the old scoring system with actionable condition data.
 
@@ -20,6 +22,10 @@ import sys
 import time
 from datetime import datetime, timezone
 
+# The tag vocabulary is shared with the app, which filters and decodes
+# tag_mask with it; db.py has no Flask dependency.
+import db
+
 DB_PATH = "ridb.db"
 
 # ============================================================
@@ -37,6 +43,7 @@ CREATE TABLE IF NOT EXISTS n_facility_conditions (
     elevation_ft            INTEGER,
     boondock_accessibility  TEXT,       -- EASY / MODERATE / ROUGH / UNKNOWN
     max_rv_length           INTEGER,
+    tag_mask                INTEGER NOT NULL DEFAULT 0,  -- bit i = db.TAG_VOCABULARY[i]
 
     classified_at           TEXT
 );
@@ -328,8 +335,10 @@ def classify(conn):
 
         # Compute tags for all facilities
         tags = compute_tags(r)
+        mask = 0
         for tag, cat, order in tags:
             tag_batch.append((fid, tag, cat, order))
+            mask |= db.TAG_BITS.get(tag, 0)  # validate() reports unknown tags
 
         # Classify conditions
         road = classify_road_access(r)
@@ -341,14 +350,14 @@ def classify(conn):
         max_rv = r['max_rv_length']
 
         cond_batch.append((
-            fid, road, surface, season, fire, elev, boondock, max_rv, now,
+            fid, road, surface, season, fire, elev, boondock, max_rv, mask, now,
         ))
 
     # Write conditions
     c = conn.cursor()
     c.execute("DELETE FROM n_facility_conditions")
     c.executemany("""
-        INSERT INTO n_facility_conditions VALUES (?,?,?,?,?,?,?,?,?)
+        INSERT INTO n_facility_conditions VALUES (?,?,?,?,?,?,?,?,?,?)
     """, cond_batch)
     print(f"  Inserted {len(cond_batch):,} condition rows")
 
@@ -441,6 +450,15 @@ def validate(conn):
     if bad:
         errors += 1
 
+    # 8. Every emitted tag has a tag_mask bit. An unknown tag would be shown
+    # on the facility page but silently missing from cards and tag filters.
+    c.execute("SELECT DISTINCT tag FROM n_facility_tags")
+    unknown = sorted(t for (t,) in c.fetchall() if t not in db.TAG_BITS)
+    print(f"\n  Tags missing from db.TAG_VOCABULARY: {unknown or 0}  "
+          f"{'OK' if not unknown else 'FAIL'}")
+    if unknown:
+        errors += 1
+
     # Tag counts
     print("\n  --- Tag Frequency ---")
     c.execute("""
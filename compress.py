@@ -0,0 +1,132 @@
+"""
+compress.py — response compression, negotiated from Accept-Encoding
+
+Cacheable responses (pins, tiles, states, sitemap) are compressed once, when
+they enter a cache, and every request after that just picks the stored
+variant. Uncached JSON is encoded in one call, by the C encoder, and then
+compressed and sent a chunk at a time, so the worker never holds a
+compressed copy of the whole body as well.
+
+gzip always (stdlib zlib). Brotli too when the `brotli` package happens to
+be installed -- it isn't a requirement, and nothing changes without it.
+No Flask dependency (same pattern as db.py and cache.py).
+"""
+
+import hashlib
+import json
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Below this, compression costs more than it saves on the wire.
+MIN_SIZE = 1024
+# Cached bodies are compressed once, so spend a little more CPU on them.
+GZIP_LEVEL_CACHED = 9
+GZIP_LEVEL_STREAM = 6
+BROTLI_QUALITY_CACHED = 9
+BROTLI_QUALITY_STREAM = 5
+STREAM_CHUNK = 16 * 1024
+
+_JSON_ENCODER = json.JSONEncoder(sort_keys=True, separators=(",", ":"))
+# What stream_json can produce.
+STREAM_CODINGS = ("identity", "gzip") + (("br",) if brotli is not None else ())
+
+
+def _gzip(data, level):
+    # wbits=31: a gzip wrapper, not a bare zlib stream.
+    c = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return c.compress(data) + c.flush()
+
+
+class EncodedBody:
+    """A response body plus its compressed variants and a strong ETag."""
+
+    __slots__ = ("etag", "variants", "size")
+
+    def __init__(self, body, gzipped=None):
+        """gzipped: body already gzipped (say, read back from disk)."""
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.variants = {"identity": body}
+        if gzipped is not None:
+            self.variants["gzip"] = gzipped
+        elif len(body) >= MIN_SIZE:
+            self.variants["gzip"] = _gzip(body, GZIP_LEVEL_CACHED)
+        if len(body) >= MIN_SIZE and brotli is not None:
+            self.variants["br"] = brotli.compress(
+                body, quality=BROTLI_QUALITY_CACHED)
+        self.size = sum(len(v) for v in self.variants.values())
+
+    @property
+    def body(self):
+        return self.variants["identity"]
+
+    def select(self, accept_encoding):
+        """(content_encoding, bytes, etag) for a request's Accept-Encoding.
+
+        Each encoding gets its own ETag: a strong validator names exact
+        bytes, and the gzip bytes aren't the identity bytes.
+        """
+        coding = negotiate(accept_encoding, self.variants)
+        if coding == "identity":
+            return None, self.body, self.etag
+        return coding, self.variants[coding], f"{self.etag}-{coding}"
+
+
+def _accepted(accept_encoding):
+    """{coding: q} from an Accept-Encoding header."""
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def negotiate(accept_encoding, available):
+    """Best of `available` the client accepts: br, then gzip, else identity."""
+    accepted = _accepted(accept_encoding)
+    for coding in ("br", "gzip"):
+        if coding in available and accepted.get(
+                coding, accepted.get("*", 0)) > 0:
+            return coding
+    return "identity"
+
+
+def stream_json(obj, coding):
+    """Yield obj as compact JSON bytes, compressed with coding as it goes.
+
+    coding is what negotiate() picked for the request ("identity" for none).
+    The encoding itself is one-shot: JSONEncoder.encode runs the C encoder,
+    where iterencode (chunked) falls back to the pure-Python one -- several
+    times slower, for bodies that are a few hundred KB at most.
+    """
+    if coding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY_STREAM)
+        compress, flush = compressor.process, compressor.finish
+    elif coding == "gzip":
+        compressor = zlib.compressobj(GZIP_LEVEL_STREAM, zlib.DEFLATED, 31)
+        compress, flush = compressor.compress, compressor.flush
+    else:
+        compress, flush = (lambda data: data), (lambda: b"")
+
+    body = (_JSON_ENCODER.encode(obj) + "\n").encode()
+    for start in range(0, len(body), STREAM_CHUNK):
+        out = compress(body[start:start + STREAM_CHUNK])
+        if out:
+            yield out
+    out = flush()
+    if out:
+        yield out
@@ -5,12 +5,32 @@ All database queries live here. Flask routes call these functions
 and receive plain dicts/lists. No Flask dependencies in this module.
 """
 
+import base64
+import bisect
+import hashlib
+import json
 import math
+import os
 import re
 import sqlite3
+import threading
+import urllib.parse
+from datetime import datetime, timezone
+
+from cache import LRUCache
 
 DB_PATH = "ridb.db"
 
+# Fingerprint of this file's source. Tables the pipeline fills by calling
+# into this module -- the pin tiles, the state first pages -- record the
+# fingerprint of the db.py that filled them in n_meta, and a db.py with a
+# different source ignores them and queries live instead (_written_by_this
+# _code). By content, not mtime: prepare_db.py runs on another machine than
+# the app does.
+with open(__file__, "rb") as _source:
+    SOURCE_VERSION = hashlib.blake2b(_source.read(), digest_size=6).hexdigest()
+del _source
+
 # Camping types searched when the caller specifies none.
 #
 # This used to be DEVELOPED-only for the search functions while map pins
@@ -20,47 +40,269 @@ DB_PATH = "ridb.db"
 DEFAULT_CAMPING_TYPES = ["DEVELOPED", "PRIMITIVE", "DISPERSED"]
 
 # ------------------------------------------------------------------
-# Preferred-address join fragment
+# Tag vocabulary
+# ------------------------------------------------------------------
+# Every tag classify.compute_tags can emit, in the order it emits them.
+# Bit i of a facility's tag_mask is TAG_VOCABULARY[i], so a tag filter is one
+# `(tag_mask & ?) = ?` instead of an EXISTS probe per tag, and the result
+# cards decode their tags from the row instead of a second query. Emission
+# order is also display_order, so decoding low bit first yields tags already
+# in display order. Lives here, not in classify.py, because the app needs
+# it and the pipeline scripts aren't deployed. Changing it means re-running
+# classify.py; validate() fails on any tag missing from this list.
+TAG_VOCABULARY = [
+    # WARNING
+    "RV_NOT_RECOMMENDED", "NO_DRIVE_IN_ACCESS", "4WD_REQUIRED",
+    "HIGH_CLEARANCE", "LENGTH_RESTRICTED", "REMOTE_NO_CELL", "FLOOD_RISK",
+    # SEASONAL, FIRE, ENVIRONMENT
+    "SEASONAL_CLOSURE", "SNOW_AREA", "FIRE_RESTRICTIONS", "HIGH_ELEVATION",
+    # RIG_SIZE
+    "BIG_RIG_FRIENDLY", "PULL_THROUGH", "BACK_IN_ONLY",
+    # HOOKUP
+    "FULL_HOOKUPS", "ELECTRIC_HOOKUP", "WATER_HOOKUP", "50_AMP", "30_AMP",
+    "DRY_CAMPING",
+    # ACCESS
+    "PAVED_ACCESS", "GRAVEL_ROAD", "DIRT_ROAD",
+    # STYLE
+    "BOONDOCKING", "PRIMITIVE", "GENERATOR_MENTIONED", "DUMP_STATION",
+    "POTABLE_WATER", "VAULT_TOILET", "RESERVABLE",
+]
+# SQLite integers are signed 64-bit; stay clear of the sign bit.
+assert len(TAG_VOCABULARY) <= 63
+
+TAG_BITS = {tag: 1 << i for i, tag in enumerate(TAG_VOCABULARY)}
+
+
+def tag_mask(tags):
+    """OR of the bits for tags, or None if any tag isn't in the vocabulary.
+
+    None rather than skipping the unknown tag: a filter on a tag no facility
+    can carry matches nothing, as the per-tag EXISTS did.
+    """
+    mask = 0
+    for tag in tags:
+        bit = TAG_BITS.get(tag)
+        if bit is None:
+            return None
+        mask |= bit
+    return mask
+
+
+def tags_from_mask(mask):
+    """Tags set in mask, in display order."""
+    return [tag for i, tag in enumerate(TAG_VOCABULARY) if mask >> i & 1]
+
+# ------------------------------------------------------------------
+# Preferred address per facility
 # ------------------------------------------------------------------
 # A facility can have several facility_addresses rows (Physical /
 # Default / Mailing, sometimes duplicates of the same type), so a bare
 # join duplicates result rows -- but filtering on address_type =
 # 'Physical' drops the ~85% of facilities whose only row is 'Default'.
-# Instead, LEFT JOIN exactly one row per facility: rows that actually
+# Instead, pick exactly one row per facility: rows that actually
 # carry a state_code beat empty ones (some facilities have a blank
 # 'Physical' row shadowing a filled-in 'Default'/'Mailing' row), then
 # Physical > Default > Mailing > anything else, then primary key so
-# the choice is deterministic.  Facilities with no address row at all
-# are kept (city/state_code come back NULL).
-# Requires the query to alias n_facility_rollup as "r"; the address
-# row is exposed as "fa".  Uses idx_fa_facility(facility_id, ...).
+# the choice is deterministic.
+#
+# This used to be a correlated ORDER BY ... LIMIT 1 subquery inside the
+# join, evaluated once per candidate row on every search -- a CA search
+# ranked the addresses of every campable facility in the country before
+# the state filter could prune anything. The pipeline now runs the
+# ranking once (prepare_db.py) and stores the winner in
+# n_facility_address, one row per facility, indexed on
+# (state_code, facility_id) so a state search is an index range scan.
+PREFERRED_ADDRESS_SQL = """
+    SELECT facility_id, facility_address_id, address_type,
+           city, state_code, postal_code, street1
+    FROM (
+        SELECT fa.*,
+               ROW_NUMBER() OVER (
+                   PARTITION BY fa.facility_id
+                   ORDER BY fa.state_code IS NULL OR fa.state_code = '',
+                            CASE fa.address_type
+                                WHEN 'Physical' THEN 0
+                                WHEN 'Default'  THEN 1
+                                WHEN 'Mailing'  THEN 2
+                                ELSE 3
+                            END,
+                            fa.facility_address_id
+               ) AS rank
+        FROM facility_addresses fa
+    )
+    WHERE rank = 1
+"""
+
+# Facilities with no address row at all are kept (city/state_code come
+# back NULL). Requires the query to alias n_facility_rollup as "r"; the
+# address row is exposed as "fa". Queries that filter on fa.state_code
+# join n_facility_address directly with an inner JOIN instead, which lets
+# the planner start from idx_nfa_state.
 PREFERRED_ADDRESS_JOIN = """
-        LEFT JOIN facility_addresses fa
-            ON fa.facility_address_id = (
-                SELECT fa2.facility_address_id
-                FROM facility_addresses fa2
-                WHERE fa2.facility_id = r.facility_id
-                ORDER BY fa2.state_code IS NULL OR fa2.state_code = '',
-                         CASE fa2.address_type
-                             WHEN 'Physical' THEN 0
-                             WHEN 'Default'  THEN 1
-                             WHEN 'Mailing'  THEN 2
-                             ELSE 3
-                         END,
-                         fa2.facility_address_id
-                LIMIT 1
-            )
+        LEFT JOIN n_facility_address fa ON fa.facility_id = r.facility_id
+"""
+
+
+# ------------------------------------------------------------------
+# Search card table
+# ------------------------------------------------------------------
+# Every search path returns the same ~30-column card, and each used to
+# build it by joining n_facility_rollup, n_facility_conditions, the
+# preferred address and n_facility_photo per request. prepare_db.py now
+# flattens that join once into n_search_card: one row per campable, named
+# facility, holding the card columns plus the few extra columns the shared
+# filters test (coords_valid, the site-style counts). Searches, counts and
+# pins all read it with zero joins.
+#
+# The card columns, in the order the search functions have always
+# returned them. The filter-only columns are deliberately left out so the
+# API's result shape doesn't change.
+CARD_COLUMNS = [
+    "facility_id", "facility_name", "org_abbrev", "camping_type",
+    "latitude", "longitude", "total_campsites",
+    "rv_type_sites", "sites_accepting_rv",
+    "has_full_hookup", "has_electric_hookup",
+    "has_water_hookup", "has_sewer_hookup", "max_amps",
+    "max_rv_length", "pullthrough_sites", "backin_sites",
+    "surface_predominant", "reservable", "full_hookup_sites",
+    "electric_hookup_sites", "camping_type_confidence",
+    "road_access", "driveway_surface", "seasonal_status",
+    "fire_status", "elevation_ft", "boondock_accessibility",
+    "city", "state_code",
+    "photo_url",
+]
+# tag_mask rides along for _attach_top_tags, which decodes and drops it.
+_CARD_SELECT = ", ".join("s." + col for col in CARD_COLUMNS) + ", s.tag_mask"
+
+
+# ------------------------------------------------------------------
+# Spatial index
+# ------------------------------------------------------------------
+# Every bbox and radius query drives from the n_facility_geo R*Tree and
+# joins the card row by card_id. CROSS JOIN pins that join order: SQLite
+# never reorders a CROSS JOIN, so the planner can't decide to walk the card
+# table and probe the R*Tree per row. The R*Tree only holds rows with
+# coords_valid = 1.
+_GEO_FROM = """
+        FROM n_facility_geo g
+        CROSS JOIN n_search_card s ON s.card_id = g.card_id
 """
 
 
+def _geo_sql(south, north, west, east):
+    """WHERE fragment selecting card rows inside a lat/lon box.
+
+    The R*Tree stores 32-bit floats, rounding each box outward, so it is
+    queried for boxes that overlap the viewport (never misses a point on the
+    edge) and the exact coordinates are rechecked on the card row (drops the
+    few the rounding let in). Returns (sql, params) with no leading AND.
+    """
+    sql = """g.max_lat >= ? AND g.min_lat <= ?
+          AND g.max_lon >= ? AND g.min_lon <= ?
+          AND s.latitude BETWEEN ? AND ?
+          AND s.longitude BETWEEN ? AND ?"""
+    return sql, [south, north, west, east, south, north, west, east]
+
+
+def _radius_box(lat, lon, radius_miles):
+    """Lat/lon box enclosing a radius; (south, north, west, east)."""
+    lat_delta = radius_miles / 69.0
+    lon_delta = radius_miles / (69.0 * max(math.cos(math.radians(lat)), 0.01))
+    return lat - lat_delta, lat + lat_delta, lon - lon_delta, lon + lon_delta
+
+
+EARTH_RADIUS_MILES = 3959
+
+
+def _proximity_sql(lat, lon, radius_miles):
+    """Great-circle radius test as plain SQL arithmetic.
+
+    The cosine of the angle between two points is the dot product of their
+    unit vectors, and n_search_card stores each facility's (sin/cos of lat
+    and lon) precomputed, so the per-row work is three multiply-adds --
+    no trig, and no Python callback per candidate. Larger dot = closer, so
+    "within radius" is dot >= cos(radius) and nearest-first is dot DESC.
+
+    Returns (dot_sql, dot_params, min_dot). Convert a dot back to miles
+    with _dot_to_miles, on the returned rows only.
+    """
+    phi, lam = math.radians(lat), math.radians(lon)
+    dot_sql = """(? * s.sin_lat
+                  + ? * s.cos_lat * s.cos_lon
+                  + ? * s.cos_lat * s.sin_lon)"""
+    dot_params = [math.sin(phi), math.cos(phi) * math.cos(lam),
+                  math.cos(phi) * math.sin(lam)]
+    min_dot = math.cos(min(radius_miles / EARTH_RADIUS_MILES, math.pi))
+    return dot_sql, dot_params, min_dot
+
+
+def _dot_to_miles(dot):
+    return EARTH_RADIUS_MILES * math.acos(min(1.0, max(-1.0, dot)))
+
+
+def _rows_with_distance(rows):
+    """Row dicts with the "_dot" column replaced by distance_miles."""
+    results = []
+    for row in rows:
+        r = dict(row)
+        r["distance_miles"] = _dot_to_miles(r.pop("_dot"))
+        results.append(r)
+    return results
+
+
+# ------------------------------------------------------------------
+# Filter clauses
+# ------------------------------------------------------------------
+# The filter SQL is the same text for every combination of filters; only
+# the parameters change. sqlite3 caches prepared statements by their exact
+# SQL text, and the map produces thousands of filter combinations: when
+# each one spelled out its own "IN (?,?,?)" and its own set of clauses,
+# nearly every query missed the cache and was re-parsed and re-planned.
+# Now:
+#   - list filters bind one JSON array, read back with json_each(?)
+#   - optional filters are always present, switched off by a NULL/0 param
+# so a handful of statement texts (search kind x cursor x window) cover
+# everything and stay prepared for the life of the pooled connection.
+
+
+def _json_list(values):
+    """A list filter as one bindable JSON array; None when absent or empty."""
+    return json.dumps(list(values)) if values else None
+
+
+def _in_list_sql(column):
+    """`column IN <list>`, or no-op when the list param is NULL. Binds it twice."""
+    return (f"  AND (? IS NULL OR {column} IN "
+            f"(SELECT value FROM json_each(?)))\n")
+
+
+def _state_sql(state_codes):
+    """WHERE fragment for the state filter. Returns (sql, params).
+
+    The one list that keeps a second shape: the planner can't see how many
+    values json_each(?) yields, so it stops reading idx_nsc_state_rank in
+    rank order and sorts the whole state instead. A single state -- the
+    common case by far -- binds as plain equality and keeps the seek.
+    """
+    if len(state_codes) == 1:
+        return "s.state_code = ?", [state_codes[0]]
+    return ("s.state_code IN (SELECT value FROM json_each(?))",
+            [_json_list(state_codes)])
+
+
 # Columns that exclusion filters can target, keyed by the request parameter.
 _EXCLUDABLE = {
-    "road_access": "c.road_access",
-    "seasonal_status": "c.seasonal_status",
-    "fire_status": "c.fire_status",
-    "agencies": "r.org_abbrev",
+    "road_access": "s.road_access",
+    "seasonal_status": "s.seasonal_status",
+    "fire_status": "s.fire_status",
+    "agencies": "s.org_abbrev",
 }
 
+_EXCLUDE_SQL = "".join(
+    f"  AND (? IS NULL OR {column} IS NULL OR {column} NOT IN "
+    f"(SELECT value FROM json_each(?)))\n"
+    for column in _EXCLUDABLE.values())
+
 
 def _exclude_sql(excludes):
     """Build "NOT" filter clauses from {param: [values]}.
@@ -73,16 +315,38 @@ def _exclude_sql(excludes):
     survives NOT IN on its own; the IS NULL arm is needed because
     `NULL NOT IN (...)` evaluates to NULL, which would drop the row.
     """
-    sql, params = "", []
-    for key, values in (excludes or {}).items():
-        column = _EXCLUDABLE.get(key)
-        if not column or not values:
-            continue
-        placeholders = ",".join("?" * len(values))
-        sql += (f"  AND ({column} IS NULL OR "
-                f"{column} NOT IN ({placeholders}))\n")
-        params.extend(values)
-    return sql, params
+    excludes = excludes or {}
+    params = []
+    for key in _EXCLUDABLE:
+        values = _json_list(excludes.get(key))
+        params.extend([values, values])
+    return _EXCLUDE_SQL, params
+
+
+# Style/hookup request values -> the card-row predicate each one requires.
+# _STYLE_TESTS / _HOOKUP_TESTS mirror these for the in-process index.
+_FEATURE_SQL = [
+    ("styles", "rv", "s.sites_accepting_rv > 0"),
+    ("styles", "tent", "s.sites_accepting_tent > 0"),
+    ("styles", "walkin", "(s.walk_in_sites > 0 OR s.hike_in_sites > 0)"),
+    ("styles", "boatin", "s.boat_in_sites > 0"),
+    ("styles", "equestrian", "s.equestrian_sites > 0"),
+    ("hookups", "electric", "s.has_electric_hookup = 1"),
+    ("hookups", "water", "s.has_water_hookup = 1"),
+    ("hookups", "sewer", "s.has_sewer_hookup = 1"),
+]
+
+_FILTER_SQL = (
+    _in_list_sql("s.org_abbrev")
+    + _in_list_sql("s.road_access")
+    + _in_list_sql("s.seasonal_status")
+    + _in_list_sql("s.fire_status")
+    + "".join(f"  AND (? = 0 OR {pred})\n" for _, _, pred in _FEATURE_SQL)
+    + "  AND (? = 0 OR s.reservable = 1)\n"
+    + "  AND (? IS NULL OR s.max_rv_length >= ? OR s.max_rv_length IS NULL)\n"
+    + _EXCLUDE_SQL
+    + "  AND (s.tag_mask & ?) = ?\n"
+)
 
 
 def _filter_sql(agencies=None, road_access=None, seasonal_status=None,
@@ -96,87 +360,522 @@ def _filter_sql(agencies=None, road_access=None, seasonal_status=None,
     path never got, and vice versa for season/fire). One builder, one
     vocabulary.
 
-    Requires n_facility_rollup aliased as "r" and n_facility_conditions as
-    "c" in the calling query. Emits clauses in a fixed order and extends
-    params in the same order. Returns (sql, params).
+    Requires n_search_card aliased as "s" in the calling query. The SQL is
+    always _FILTER_SQL; filters not in use bind NULL or 0, which switches
+    their clause off. Returns (sql, params).
 
-    `reservable` is deliberately require-only (no exclude): r.reservable has
+    `reservable` is deliberately require-only (no exclude): s.reservable has
     zero NULLs because RIDB conflates "not reservable" with "no data", so a
     "not reservable" filter would promise a distinction the data can't make.
     """
-    sql, params = "", []
-
-    if agencies:
-        sql += "  AND r.org_abbrev IN ({})\n".format(','.join('?' * len(agencies)))
-        params.extend(agencies)
-
-    if road_access:
-        sql += "  AND c.road_access IN ({})\n".format(','.join('?' * len(road_access)))
-        params.extend(road_access)
-
-    if seasonal_status:
-        sql += "  AND c.seasonal_status IN ({})\n".format(','.join('?' * len(seasonal_status)))
-        params.extend(seasonal_status)
-
-    if fire_status:
-        sql += "  AND c.fire_status IN ({})\n".format(','.join('?' * len(fire_status)))
-        params.extend(fire_status)
-
-    if styles:
-        for s in styles:
-            if s == 'rv':
-                sql += "  AND r.sites_accepting_rv > 0\n"
-            elif s == 'tent':
-                sql += "  AND r.sites_accepting_tent > 0\n"
-            elif s == 'walkin':
-                sql += "  AND (r.walk_in_sites > 0 OR r.hike_in_sites > 0)\n"
-            elif s == 'boatin':
-                sql += "  AND r.boat_in_sites > 0\n"
-            elif s == 'equestrian':
-                sql += "  AND r.equestrian_sites > 0\n"
-
-    if hookups:
-        for h in hookups:
-            if h == 'electric':
-                sql += "  AND r.has_electric_hookup = 1\n"
-            elif h == 'water':
-                sql += "  AND r.has_water_hookup = 1\n"
-            elif h == 'sewer':
-                sql += "  AND r.has_sewer_hookup = 1\n"
-
-    if reservable:
-        sql += "  AND r.reservable = 1\n"
-
-    if min_rv_length:
-        sql += "  AND (r.max_rv_length >= ? OR r.max_rv_length IS NULL)\n"
-        params.append(min_rv_length)
+    params = []
+    for values in (agencies, road_access, seasonal_status, fire_status):
+        values = _json_list(values)
+        params.extend([values, values])
+
+    wanted = {"styles": set(styles or ()), "hookups": set(hookups or ())}
+    for kind, name, _ in _FEATURE_SQL:
+        params.append(1 if name in wanted[kind] else 0)
+
+    params.append(1 if reservable else 0)
+
+    rv = min_rv_length or None
+    params.extend([rv, rv])
 
     # Exclusion ("not") filters — keep unknowns, see _exclude_sql
-    ex_sql, ex_params = _exclude_sql(excludes)
-    sql += ex_sql
-    params.extend(ex_params)
-
-    if tag_filters:
-        for tag in tag_filters:
-            sql += """
-          AND EXISTS (SELECT 1 FROM n_facility_tags t
-                      WHERE t.facility_id = r.facility_id AND t.tag = ?)
-            """
-            params.append(tag)
+    params.extend(_exclude_sql(excludes)[1])
 
-    return sql, params
+    # (tag_mask & 0) = 0 holds for every row, so no tags is mask 0. An
+    # unknown tag matches nothing: no row's masked bits can equal -1.
+    mask = tag_mask(tag_filters or ())
+    params.extend([0, -1] if mask is None else [mask, mask])
 
+    return _FILTER_SQL, params
 
-def get_connection():
-    conn = sqlite3.connect(DB_PATH)
+
+# ------------------------------------------------------------------
+# In-process facility index
+# ------------------------------------------------------------------
+# Map panning fires /api/pins and the bounds count constantly, and the whole
+# mappable set is only a few thousand rows -- small enough to hold in each
+# worker and answer with set algebra instead of SQL. Every filter value gets
+# a bitset (a Python int, bit i = row i), so a filter is a handful of
+# big-int ANDs/ORs over ~7K bits, all in C. Rows are sorted by latitude,
+# which makes a latitude range one contiguous run of bits; longitude is
+# bucketed by whole degree, with the two edge buckets checked exactly.
+#
+# Stdlib only: the masks are what NumPy would give us, without adding a
+# compiled dependency to a Flask + gunicorn deploy.
+#
+# The masks must select exactly the rows _filter_sql does, because the
+# viewport list (search_by_bounds) is still SQL and has to match the pins.
+# Anything added to _filter_sql needs its twin in _FacilityIndex.match.
+
+# Request-parameter style/hookup values -> predicate over a card row,
+# mirroring their _FEATURE_SQL clauses.
+_STYLE_TESTS = {
+    "rv": lambda r: (r["sites_accepting_rv"] or 0) > 0,
+    "tent": lambda r: (r["sites_accepting_tent"] or 0) > 0,
+    "walkin": lambda r: (r["walk_in_sites"] or 0) > 0 or (r["hike_in_sites"] or 0) > 0,
+    "boatin": lambda r: (r["boat_in_sites"] or 0) > 0,
+    "equestrian": lambda r: (r["equestrian_sites"] or 0) > 0,
+}
+_HOOKUP_TESTS = {
+    "electric": lambda r: r["has_electric_hookup"] == 1,
+    "water": lambda r: r["has_water_hookup"] == 1,
+    "sewer": lambda r: r["has_sewer_hookup"] == 1,
+}
+
+# Card columns filtered by value (IN lists and excludes).
+_INDEXED_VALUES = ["camping_type", "org_abbrev", "road_access",
+                   "seasonal_status", "fire_status"]
+
+_PIN_COLUMNS = ["facility_id", "facility_name", "latitude", "longitude",
+                "camping_type", "total_campsites", "org_abbrev",
+                "max_rv_length", "seasonal_status"]
+_NEARBY_COLUMNS = ["facility_id", "facility_name", "org_abbrev",
+                   "camping_type", "latitude", "longitude", "max_rv_length",
+                   "total_campsites", "road_access", "boondock_accessibility",
+                   "city", "state_code"]
+
+
+def _set_bits(mask):
+    """Indexes of the set bits in an int, lowest first."""
+    bits = bin(mask)[:1:-1]
+    i = bits.find("1")
+    while i >= 0:
+        yield i
+        i = bits.find("1", i + 1)
+
+
+class _FacilityIndex:
+    """Columnar bitset index over n_search_card rows with valid coordinates."""
+
+    def __init__(self, conn):
+        rows = conn.execute("""
+            SELECT *
+            FROM n_search_card
+            WHERE coords_valid = 1
+            ORDER BY latitude, card_id
+        """).fetchall()
+        self.rows = [dict(r) for r in rows]
+        self.lats = [r["latitude"] for r in self.rows]
+        self.position = {r["facility_id"]: i for i, r in enumerate(self.rows)}
+
+        self.values = {col: {} for col in _INDEXED_VALUES}
+        self.styles = dict.fromkeys(_STYLE_TESTS, 0)
+        self.hookups = dict.fromkeys(_HOOKUP_TESTS, 0)
+        self.reservable = 0
+        self.rv_lengths = {}        # max_rv_length -> bitset (None = unknown)
+        self.lon_buckets = {}       # floor(longitude) -> bitset
+        self.lon_sorted = {}        # floor(longitude) -> sorted [(lon, i)]
+        for i, r in enumerate(self.rows):
+            bit = 1 << i
+            for col in _INDEXED_VALUES:
+                vals = self.values[col]
+                vals[r[col]] = vals.get(r[col], 0) | bit
+            for name, test in _STYLE_TESTS.items():
+                if test(r):
+                    self.styles[name] |= bit
+            for name, test in _HOOKUP_TESTS.items():
+                if test(r):
+                    self.hookups[name] |= bit
+            if r["reservable"] == 1:
+                self.reservable |= bit
+            rv = r["max_rv_length"]
+            self.rv_lengths[rv] = self.rv_lengths.get(rv, 0) | bit
+            b = math.floor(r["longitude"])
+            self.lon_buckets[b] = self.lon_buckets.get(b, 0) | bit
+            self.lon_sorted.setdefault(b, []).append((r["longitude"], i))
+        for entries in self.lon_sorted.values():
+            entries.sort()
+
+        # One bitset per tag bit: tag_rows[j] = rows whose tag_mask has bit j.
+        self.tag_rows = [0] * len(TAG_VOCABULARY)
+        for i, r in enumerate(self.rows):
+            for j in _set_bits(r["tag_mask"]):
+                self.tag_rows[j] |= 1 << i
+
+    def _box(self, south, north, west, east):
+        """Bitset of rows with south <= lat <= north, west <= lon <= east."""
+        # Also false for NaN bounds, which BETWEEN treats as NULL.
+        if not (south <= north and west <= east):
+            return 0
+        lo = bisect.bisect_left(self.lats, south)
+        hi = bisect.bisect_right(self.lats, north)
+        if lo >= hi:
+            return 0
+        lat_mask = ((1 << (hi - lo)) - 1) << lo
+
+        west, east = max(west, -361.0), min(east, 361.0)
+        wb, eb = math.floor(west), math.floor(east)
+        lon_mask = 0
+        for b, bits in self.lon_buckets.items():
+            if wb < b < eb:
+                lon_mask |= bits
+        for b in {wb, eb}:
+            entries = self.lon_sorted.get(b, ())
+            start = bisect.bisect_left(entries, (west, -1))
+            for lon, i in entries[start:]:
+                if lon > east:
+                    break
+                lon_mask |= 1 << i
+        return lat_mask & lon_mask
+
+    def match(self, south, north, west, east, camping_types=None,
+              agencies=None, road_access=None, seasonal_status=None,
+              fire_status=None, styles=None, hookups=None, reservable=None,
+              min_rv_length=None, excludes=None, tag_filters=None):
+        """Bitset of rows in the box passing the filters, as _filter_sql."""
+        mask = self._box(south, north, west, east)
+        if not mask:
+            return 0
+
+        def any_of(col, wanted):
+            vals = self.values[col]
+            bits = 0
+            for v in wanted:
+                bits |= vals.get(v, 0)
+            return bits
+
+        mask &= any_of("camping_type",
+                       camping_types or DEFAULT_CAMPING_TYPES)
+        if agencies:
+            mask &= any_of("org_abbrev", agencies)
+        if road_access:
+            mask &= any_of("road_access", road_access)
+        if seasonal_status:
+            mask &= any_of("seasonal_status", seasonal_status)
+        if fire_status:
+            mask &= any_of("fire_status", fire_status)
+        for s in styles or ():
+            if s in self.styles:
+                mask &= self.styles[s]
+        for h in hookups or ():
+            if h in self.hookups:
+                mask &= self.hookups[h]
+        if reservable:
+            mask &= self.reservable
+        if min_rv_length:
+            rv_mask = 0
+            for length, bits in self.rv_lengths.items():
+                if length is None or length >= min_rv_length:
+                    rv_mask |= bits
+            mask &= rv_mask
+        # Excludes keep unknowns: NULL rows sit in no value's bitset, so
+        # removing the excluded values' bits can never remove them.
+        for key, values in (excludes or {}).items():
+            column = _EXCLUDABLE.get(key)
+            if column and values:
+                mask &= ~any_of(column[2:], values)
+        if tag_filters:
+            wanted = tag_mask(tag_filters)
+            if wanted is None:
+                return 0
+            for j in _set_bits(wanted):
+                mask &= self.tag_rows[j]
+        return mask
+
+    def pins(self, mask):
+        rows = self.rows
+        return [{col: rows[i][col] for col in _PIN_COLUMNS}
+                for i in _set_bits(mask)]
+
+    def nearest(self, facility_id, lat, lon, radius_miles, limit):
+        """[(dot, row)] of the nearest rows within the radius, nearest
+        first (ties by facility_id), excluding facility_id itself."""
+        mask = self._box(*_radius_box(lat, lon, radius_miles))
+        own = self.position.get(facility_id)
+        if own is not None:
+            mask &= ~(1 << own)
+        _, (a, b, c), min_dot = _proximity_sql(lat, lon, radius_miles)
+        hits = []
+        for i in _set_bits(mask):
+            r = self.rows[i]
+            # Same expression, same evaluation order as the SQL dot product.
+            dot = (a * r["sin_lat"]
+                   + b * r["cos_lat"] * r["cos_lon"]
+                   + c * r["cos_lat"] * r["sin_lon"])
+            if dot >= min_dot:
+                hits.append((-dot, r["facility_id"], i))
+        hits.sort()
+        return [(-neg_dot, i) for neg_dot, _, i in hits[:limit]]
+
+    def nearby_rows(self, hits):
+        """Nearby-list dicts for nearest()'s [(dot, row)]."""
+        results = []
+        for dot, i in hits:
+            r = {col: self.rows[i][col] for col in _NEARBY_COLUMNS}
+            r["distance_miles"] = _dot_to_miles(dot)
+            results.append(r)
+        return results
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def facility_index(conn):
+    """The worker's _FacilityIndex, built from conn on first use.
+
+    A few tens of milliseconds, once per process and database file: when
+    a connection checkout sees the file's identity change (a swap or an
+    in-place write while the workers are up, see "Connections"),
+    _note_identity drops the index with the other derived state, and the
+    next call rebuilds it from the new file. gunicorn.conf.py builds it in
+    the master before the fork (app.warm).
+    """
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = _FacilityIndex(conn)
+    return _index
+
+
+# ------------------------------------------------------------------
+# Keyset pagination
+# ------------------------------------------------------------------
+# LIMIT/OFFSET makes SQLite build and throw away every row before the page:
+# page 40 of a national search sorted 975 rows to return 25. A cursor names
+# the last row of the previous page instead, and the next page seeks past
+# it -- for state search that's a range seek on idx_nsc_state_rank, and for
+# the R*Tree paths the sorter only has to keep `limit` rows. Tokens are
+# opaque to clients (base64 of a small JSON list); the sort keys always end
+# in facility_id so every row has exactly one position.
+#
+# Rank order (total_campsites DESC, facility_id) encodes both keys. Distance
+# order encodes only the facility_id: its dot product is recomputed by the
+# same SQL expression, so the seek compares bit-identical doubles, where a
+# round trip through miles and acos would not be.
+
+class InvalidCursor(ValueError):
+    """A pagination cursor that doesn't decode, or belongs to another sort."""
+
+
+def next_cursor(results, by_distance=False):
+    """Cursor for the page after results, or None if results is empty."""
+    if not results:
+        return None
+    last = results[-1]
+    if by_distance:
+        payload = ["d", last["facility_id"]]
+    else:
+        payload = ["r", last["total_campsites"], last["facility_id"]]
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(token, kind):
+    """The cursor's sort keys; InvalidCursor if it isn't a `kind` cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        payload = json.loads(raw)
+    except (ValueError, TypeError):
+        raise InvalidCursor(token)
+    if kind == "r":
+        ok = (isinstance(payload, list) and len(payload) == 3
+              and payload[0] == "r" and isinstance(payload[1], int)
+              and isinstance(payload[2], str))
+    else:
+        ok = (isinstance(payload, list) and len(payload) == 2
+              and payload[0] == "d" and isinstance(payload[1], str))
+    if not ok:
+        raise InvalidCursor(token)
+    return payload[1:]
+
+
+def _rank_seek_sql(cursor):
+    """Clause selecting rows after a rank-order cursor. Returns (sql, params).
+
+    The bare `<=` is the part an index can seek on; the OR only breaks ties.
+    """
+    campsites, facility_id = _decode_cursor(cursor, "r")
+    sql = """  AND s.total_campsites <= ?
+          AND (s.total_campsites < ? OR s.facility_id > ?)\n"""
+    return sql, [campsites, campsites, facility_id]
+
+
+# ------------------------------------------------------------------
+# Result totals
+# ------------------------------------------------------------------
+# Every /search and /api/search call used to run its filtered query twice:
+# once for the page, once more to count it. Now the page query carries
+# COUNT(*) OVER (), which SQLite evaluates over the whole filtered set before
+# LIMIT, so the first page comes back with its total from one execution.
+# Totals are then cached under a normalized signature of the search, so the
+# Load More pages (cursor seeks, which only see the rows after the cursor)
+# reuse it instead of recounting. The data only changes on a deploy, which
+# restarts the workers, so entries never go stale.
+
+_totals = LRUCache(maxsize=2048)
+
+
+def _count_key(state_codes, lat, lon, radius_miles, camping_types, filters):
+    """Cache key for a search's total, equal for searches that match the same rows.
+
+    Lists become sorted, de-duplicated tuples and empty values drop out, so
+    `?agency=FS&agency=BLM` and `?agency=BLM&agency=FS` share one entry.
+    """
+    def norm(values):
+        return tuple(sorted(set(values))) if values else None
+
+    sig = [norm(camping_types or DEFAULT_CAMPING_TYPES)]
+    for name in ("agencies", "road_access", "seasonal_status", "fire_status",
+                 "styles", "hookups", "tag_filters"):
+        sig.append(norm(filters.get(name)))
+    sig.append(1 if filters.get("reservable") else None)
+    sig.append(filters.get("min_rv_length") or None)
+    excludes = filters.get("excludes") or {}
+    sig.append(tuple(sorted((k, norm(v)) for k, v in excludes.items()
+                            if k in _EXCLUDABLE and v)))
+    if state_codes:
+        where = ("state", norm(state_codes))
+    else:
+        where = ("radius", lat, lon, radius_miles)
+    return where + tuple(sig)
+
+
+def _take_window_total(results, windowed, offset):
+    """Pop the COUNT(*) OVER () column off a page; the total, or None if unknown.
+
+    An empty page past the end (offset > 0) carries no row to read it from.
+    """
+    if not windowed:
+        return None
+    total = None
+    for r in results:
+        total = r.pop("_total")
+    if total is None and offset == 0:
+        total = 0
+    return total
+
+
+# ------------------------------------------------------------------
+# Connections
+# ------------------------------------------------------------------
+# One read-only connection per thread, reused for the life of the worker.
+# Opening per request meant every request paid to open the file, parse the
+# schema and start from a cold page cache. The app never writes (see
+# deploy.sh), so connections open with mode=ro, and with immutable=1 --
+# no locking, no change detection -- unless a -wal file says another
+# process has been writing. Change detection is done here instead: every
+# checkout stats the file, and a new (inode, mtime, size) reopens the
+# connection and bumps the generation, which drops everything derived from
+# the old file (the facility index, cached totals, register_cache()'d
+# response caches). deploy.sh stops the service around a swap anyway; this
+# covers a swap or in-place write that happens while workers are up.
+
+_CONNECTION_PRAGMAS = [
+    "PRAGMA mmap_size = 268435456",   # 256 MiB: maps the whole ~72MB app DB
+    "PRAGMA cache_size = -16384",     # 16 MiB page cache per connection
+    "PRAGMA temp_store = MEMORY",     # ORDER BY / window sorts
+    "PRAGMA query_only = 1",          # belt and braces on top of mode=ro
+]
+
+_pool = threading.local()
+_generation = 0
+# Caches of anything read from the database, emptied when the file changes.
+_derived_caches = [_totals]
+_generation_lock = threading.Lock()
+_db_identity = None
+# Connections a forked child inherited from its parent. SQLite connections
+# must not cross a fork; closing one in the child can disturb the parent's
+# file state, so the child keeps a reference and never touches it.
+_inherited = []
+
+
+def _file_identity(path):
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def generation():
+    """Incremented whenever the database file changes. Key caches on it."""
+    return _generation
+
+
+def register_cache(cache):
+    """Have cache (anything with .clear()) emptied whenever the file changes."""
+    _derived_caches.append(cache)
+    return cache
+
+
+def _note_identity(identity):
+    """Record the file's identity, invalidating derived state if it changed."""
+    global _generation, _db_identity, _index
+    if identity == _db_identity:
+        return
+    with _generation_lock:
+        if identity != _db_identity:
+            if _db_identity is not None:
+                _generation += 1
+                for cache in _derived_caches:
+                    cache.clear()
+                _index = None
+            _db_identity = identity
+
+
+def _open_connection(path):
+    uri = "file:{}?mode=ro".format(urllib.parse.quote(os.path.abspath(path)))
+    if not os.path.exists(path + "-wal"):
+        uri += "&immutable=1"
+    conn = sqlite3.connect(uri, uri=True)
     conn.row_factory = sqlite3.Row
-    conn.create_function("radians", 1, math.radians)
-    conn.create_function("cos", 1, math.cos)
-    conn.create_function("sin", 1, math.sin)
-    conn.create_function("acos", 1, math.acos)
+    for pragma in _CONNECTION_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
+def get_connection():
+    """This thread's pooled, read-only connection to DB_PATH.
+
+    Shared by every request the thread serves: callers must not close it.
+    """
+    identity = _file_identity(DB_PATH)
+    _note_identity(identity)
+    key = (os.getpid(), DB_PATH, identity)
+    pooled = getattr(_pool, "entry", None)
+    if pooled is not None:
+        conn, opened_for = pooled
+        if opened_for == key:
+            return conn
+        if opened_for[0] == key[0]:
+            conn.close()
+        else:
+            _inherited.append(conn)
+    conn = _open_connection(DB_PATH)
+    _pool.entry = (conn, key)
+    return conn
+
+
+def release_connection():
+    """Close this thread's pooled connection, if it has one.
+
+    For a process about to fork -- gunicorn's master after warming a
+    preloaded app -- so the workers start with no connection to inherit.
+    """
+    pooled = getattr(_pool, "entry", None)
+    if pooled is not None:
+        conn, opened_for = pooled
+        if opened_for[0] == os.getpid():
+            conn.close()
+        _pool.entry = None
+
+
+def warm_file(path=None, chunk=1 << 20):
+    """Read the database file through once, so its pages are in the OS
+    page cache -- which every worker's mmap shares -- before the first
+    request needs them. Returns the bytes read."""
+    size = 0
+    with open(path or DB_PATH, "rb", buffering=0) as f:
+        while True:
+            n = len(f.read(chunk))
+            if not n:
+                return size
+            size += n
+
+
 # ------------------------------------------------------------------
 # State list (for search dropdown)
 # ------------------------------------------------------------------
@@ -188,6 +887,74 @@ def get_states(conn):
     return [dict(r) for r in rows]
 
 
+# ------------------------------------------------------------------
+# State first pages
+# ------------------------------------------------------------------
+# Picking a state and nothing else is the most common search there is. Its
+# first page -- default camping types, no filters -- is computed when the
+# state cache is built (state_first_pages, by search_by_state itself) and
+# stored beside the count in n_state_cache.first_page, so search_by_state
+# answers it from a dict loaded once per database generation.
+
+STATE_FIRST_PAGE = 25
+
+_state_pages = (None, None)
+# n_meta key -> (generation, whether it holds SOURCE_VERSION)
+_code_marks = {}
+
+
+def _written_by_this_code(conn, key):
+    """Whether n_meta[key] is SOURCE_VERSION: the table it vouches for was
+    filled by this db.py."""
+    gen, current = _code_marks.get(key, (None, False))
+    if gen != _generation:
+        row = None
+        try:
+            row = conn.execute(
+                "SELECT value FROM n_meta WHERE key = ?", (key,)).fetchone()
+        except sqlite3.OperationalError:
+            pass
+        current = bool(row) and row[0] == SOURCE_VERSION
+        _code_marks[key] = (_generation, current)
+    return current
+
+
+def state_first_pages(conn, state_codes):
+    """(state_code, first_page JSON) for each state, for n_state_cache."""
+    for code in state_codes:
+        results, total = search_by_state(conn, [code], limit=STATE_FIRST_PAGE,
+                                         with_total=True, precomputed=False)
+        yield code, json.dumps({"total": total, "results": results},
+                               separators=(",", ":"))
+
+
+def _stored_first_page(conn, state_code):
+    """(results, total) from n_state_cache.first_page, or None.
+
+    None for every state if the pages were written by a different db.py
+    (n_meta 'state_page_code'): a new card shape or ordering must not be
+    answered with the old one.
+    """
+    global _state_pages
+    gen, pages = _state_pages
+    if gen != _generation:
+        rows = []
+        if _written_by_this_code(conn, "state_page_code"):
+            try:
+                rows = conn.execute("""
+                    SELECT state_code, first_page FROM n_state_cache
+                    WHERE first_page IS NOT NULL
+                """).fetchall()
+            except sqlite3.OperationalError:
+                pass        # built before the column existed
+        pages = {}
+        for code, page in rows:
+            page = json.loads(page)
+            pages[code] = (page["results"], page["total"])
+        _state_pages = (_generation, pages)
+    return pages.get(state_code)
+
+
 # ------------------------------------------------------------------
 # Search by state
 # ------------------------------------------------------------------
@@ -197,48 +964,68 @@ def search_by_state(conn, state_codes, camping_types=None,
                     road_access=None, seasonal_status=None, fire_status=None,
                     styles=None, hookups=None, reservable=None,
                     min_rv_length=None, excludes=None,
-                    limit=25, offset=0):
+                    limit=25, offset=0, cursor=None, with_total=False,
+                    precomputed=True):
+    """One page of a state search, largest campgrounds first.
+
+    Pass cursor=next_cursor(previous_page) to seek instead of skipping; a
+    malformed cursor raises InvalidCursor. offset still works, and
+    is applied after the cursor if both are given.
+
+    with_total=True returns (results, total) instead: the total comes from
+    the same statement as the page on the first call, and from the cache
+    after that (see "Result totals").
+
+    The first page of a single state with no filters comes from
+    n_state_cache (see "State first pages") unless precomputed=False.
+    """
     if isinstance(state_codes, str):
         state_codes = [state_codes]
     if not camping_types:
         camping_types = list(DEFAULT_CAMPING_TYPES)
-
-    sql = """
-        SELECT
-            r.facility_id, r.facility_name, r.org_abbrev, r.camping_type,
-            r.latitude, r.longitude, r.total_campsites,
-            r.rv_type_sites, r.sites_accepting_rv,
-            r.has_full_hookup, r.has_electric_hookup,
-            r.has_water_hookup, r.has_sewer_hookup, r.max_amps,
-            r.max_rv_length, r.pullthrough_sites, r.backin_sites,
-            r.surface_predominant, r.reservable, r.full_hookup_sites,
-            r.electric_hookup_sites, r.camping_type_confidence,
-            c.road_access, c.driveway_surface, c.seasonal_status,
-            c.fire_status, c.elevation_ft, c.boondock_accessibility,
-            fa.city, fa.state_code,
-            p.photo_url
-        FROM n_facility_rollup r
-        JOIN n_facility_conditions c ON r.facility_id = c.facility_id
-        {addr_join}
-        LEFT JOIN n_facility_photo p ON r.facility_id = p.facility_id
-        WHERE r.facility_name IS NOT NULL AND r.facility_name <> ''
-          AND fa.state_code IN ({})
-          AND r.camping_type IN ({})
-    """.format(','.join('?' * len(state_codes)), ','.join('?' * len(camping_types)),
-               addr_join=PREFERRED_ADDRESS_JOIN)
-    params = list(state_codes) + camping_types
-
-    f_sql, f_params = _filter_sql(
+    filters = dict(
         agencies=agencies, road_access=road_access,
         seasonal_status=seasonal_status, fire_status=fire_status,
         styles=styles, hookups=hookups, reservable=reservable,
         min_rv_length=min_rv_length, excludes=excludes,
         tag_filters=tag_filters)
+
+    if (precomputed and len(state_codes) == 1 and limit == STATE_FIRST_PAGE
+            and not offset and not cursor and not any(filters.values())
+            and set(camping_types) == set(DEFAULT_CAMPING_TYPES)):
+        page = _stored_first_page(conn, state_codes[0])
+        if page is not None:
+            # Copies: callers may annotate their rows.
+            results = [dict(r) for r in page[0]]
+            return (results, page[1]) if with_total else results
+
+    total = None
+    if with_total:
+        key = _count_key(state_codes, None, None, None, camping_types, filters)
+        total = _totals.get(key)
+    windowed = with_total and total is None and not cursor
+
+    state_sql, state_params = _state_sql(state_codes)
+    sql = """
+        SELECT {cols}{window}
+        FROM n_search_card s
+        WHERE {}
+          AND s.camping_type IN (SELECT value FROM json_each(?))
+    """.format(state_sql, cols=_CARD_SELECT,
+               window=", COUNT(*) OVER () AS _total" if windowed else "")
+    params = state_params + [_json_list(camping_types)]
+
+    f_sql, f_params = _filter_sql(**filters)
     sql += f_sql
     params.extend(f_params)
 
+    if cursor:
+        seek_sql, seek_params = _rank_seek_sql(cursor)
+        sql += seek_sql
+        params.extend(seek_params)
+
     sql += """
-        ORDER BY r.total_campsites DESC
+        ORDER BY s.total_campsites DESC, s.facility_id
         LIMIT ? OFFSET ?
     """
     params.extend([limit, offset])
@@ -247,9 +1034,17 @@ def search_by_state(conn, state_codes, camping_types=None,
     results = [dict(r) for r in rows]
 
     # Attach tags to each result
-    _attach_top_tags(conn, results)
+    _attach_top_tags(results)
 
-    return results
+    if not with_total:
+        return results
+    if total is None:
+        total = _take_window_total(results, windowed, offset)
+        if total is None:
+            total = get_search_count(conn, state_codes=state_codes,
+                                     camping_types=camping_types, **filters)
+        _totals.put(key, total)
+    return results, total
 
 
 # ------------------------------------------------------------------
@@ -262,73 +1057,81 @@ def search_by_location(conn, lat, lon, radius_miles=100,
                        road_access=None, seasonal_status=None, fire_status=None,
                        styles=None, hookups=None, reservable=None,
                        min_rv_length=None, excludes=None,
-                       limit=25, offset=0):
+                       limit=25, offset=0, cursor=None, with_total=False):
+    """One page of a radius search, nearest first.
+
+    Paginates and counts like search_by_state; build the cursor with
+    next_cursor(results, by_distance=True).
+    """
     if not camping_types:
         camping_types = list(DEFAULT_CAMPING_TYPES)
-
-    # Bounding box
-    lat_delta = radius_miles / 69.0
-    lon_delta = radius_miles / (69.0 * max(math.cos(math.radians(lat)), 0.01))
-    lat_min, lat_max = lat - lat_delta, lat + lat_delta
-    lon_min, lon_max = lon - lon_delta, lon + lon_delta
-
-    # Haversine expression (reused in WHERE and SELECT)
-    haversine = """(3959 * acos(
-                min(1.0, max(-1.0,
-                    cos(radians(?)) * cos(radians(r.latitude))
-                    * cos(radians(r.longitude) - radians(?))
-                    + sin(radians(?)) * sin(radians(r.latitude))
-                ))))"""
-    hav_params = [lat, lon, lat]
-
-    sql = """
-        SELECT
-            r.facility_id, r.facility_name, r.org_abbrev, r.camping_type,
-            r.latitude, r.longitude, r.total_campsites,
-            r.rv_type_sites, r.sites_accepting_rv,
-            r.has_full_hookup, r.has_electric_hookup,
-            r.has_water_hookup, r.has_sewer_hookup, r.max_amps,
-            r.max_rv_length, r.pullthrough_sites, r.backin_sites,
-            r.surface_predominant, r.reservable, r.full_hookup_sites,
-            r.electric_hookup_sites, r.camping_type_confidence,
-            c.road_access, c.driveway_surface, c.seasonal_status,
-            c.fire_status, c.elevation_ft, c.boondock_accessibility,
-            fa.city, fa.state_code,
-            p.photo_url,
-            {} AS distance_miles
-        FROM n_facility_rollup r
-        JOIN n_facility_conditions c ON r.facility_id = c.facility_id
-        {addr_join}
-        LEFT JOIN n_facility_photo p ON r.facility_id = p.facility_id
-        WHERE r.coords_valid = 1
-          AND r.facility_name IS NOT NULL AND r.facility_name <> ''
-          AND r.latitude BETWEEN ? AND ?
-          AND r.longitude BETWEEN ? AND ?
-          AND r.camping_type IN ({})
-          AND {} <= ?
-    """.format(haversine, ','.join('?' * len(camping_types)), haversine,
-               addr_join=PREFERRED_ADDRESS_JOIN)
-    params = hav_params + [lat_min, lat_max, lon_min, lon_max] + camping_types + hav_params + [radius_miles]
-
-    f_sql, f_params = _filter_sql(
+    filters = dict(
         agencies=agencies, road_access=road_access,
         seasonal_status=seasonal_status, fire_status=fire_status,
         styles=styles, hookups=hookups, reservable=reservable,
         min_rv_length=min_rv_length, excludes=excludes,
         tag_filters=tag_filters)
+
+    total = None
+    if with_total:
+        key = _count_key(None, lat, lon, radius_miles, camping_types, filters)
+        total = _totals.get(key)
+    windowed = with_total and total is None and not cursor
+
+    # Bounding box (the R*Tree's candidate set)
+    geo_sql, geo_params = _geo_sql(*_radius_box(lat, lon, radius_miles))
+
+    dot_sql, dot_params, min_dot = _proximity_sql(lat, lon, radius_miles)
+
+    sql = """
+        SELECT {cols},
+            {} AS _dot{window}
+    """.format(dot_sql, cols=_CARD_SELECT,
+               window=", COUNT(*) OVER () AS _total" if windowed else "") + _GEO_FROM + """
+        WHERE {}
+          AND s.camping_type IN (SELECT value FROM json_each(?))
+          AND {} >= ?
+    """.format(geo_sql, dot_sql)
+    params = (dot_params + geo_params + [_json_list(camping_types)]
+              + dot_params + [min_dot])
+
+    f_sql, f_params = _filter_sql(**filters)
     sql += f_sql
     params.extend(f_params)
 
-    sql += """
-        ORDER BY distance_miles ASC
-        LIMIT ? OFFSET ?
-    """
-    params.extend([limit, offset])
-
-    rows = conn.execute(sql, params).fetchall()
-    results = [dict(r) for r in rows]
-    _attach_top_tags(conn, results)
-    return results
+    results = None
+    if cursor:
+        (after_id,) = _decode_cursor(cursor, "d")
+        anchor = conn.execute(
+            "SELECT {} FROM n_search_card s WHERE s.facility_id = ?".format(dot_sql),
+            dot_params + [after_id]).fetchone()
+        if anchor is None:
+            results = []
+        else:
+            sql += """  AND {dot} <= ?
+          AND ({dot} < ? OR s.facility_id > ?)\n""".format(dot=dot_sql)
+            params.extend(dot_params + [anchor[0]] + dot_params + [anchor[0], after_id])
+
+    if results is None:
+        sql += """
+            ORDER BY _dot DESC, s.facility_id
+            LIMIT ? OFFSET ?
+        """
+        params.extend([limit, offset])
+
+        results = _rows_with_distance(conn.execute(sql, params).fetchall())
+        _attach_top_tags(results)
+
+    if not with_total:
+        return results
+    if total is None:
+        total = _take_window_total(results, windowed, offset)
+        if total is None:
+            total = get_search_count(conn, lat=lat, lon=lon,
+                                     radius_miles=radius_miles,
+                                     camping_types=camping_types, **filters)
+        _totals.put(key, total)
+    return results, total
 
 
 # ------------------------------------------------------------------
@@ -336,7 +1139,24 @@ def search_by_location(conn, lat, lon, radius_miles=100,
 # ------------------------------------------------------------------
 
 def get_facility(conn, facility_id):
-    row = conn.execute("""
+    return get_facilities(conn, [facility_id]).get(facility_id)
+
+
+# Photos per facility on the detail page and in the API.
+FACILITY_PHOTO_LIMIT = 12
+
+
+def get_facilities(conn, facility_ids):
+    """{facility_id: detail dict} for the ids that exist.
+
+    Set-based: the facility rows, tags, activities and photos are one query
+    each however many ids there are, so hydrating a page of search results
+    costs four queries, not four per result. The ids are bound as one JSON
+    array (json_each), which keeps the SQL text -- and so the prepared
+    statement -- the same for every batch.
+    """
+    ids = _json_list(list(dict.fromkeys(facility_ids)))
+    rows = conn.execute("""
         SELECT
             r.*,
             c.road_access, c.driveway_surface, c.seasonal_status,
@@ -353,146 +1173,183 @@ def get_facility(conn, facility_id):
         LEFT JOIN facilities f ON r.facility_id = f.facility_id
         {addr_join}
         LEFT JOIN n_facility_photo p ON r.facility_id = p.facility_id
-        WHERE r.facility_id = ?
-    """.format(addr_join=PREFERRED_ADDRESS_JOIN), (facility_id,)).fetchone()
-
-    if not row:
-        return None
-
-    data = dict(row)
-
-    # Null out fields that are empty-but-truthy HTML (e.g. <ul><li></li></ul>)
-    for field in ("facility_description", "facility_directions", "facility_use_fee"):
-        raw = data.get(field) or ""
-        stripped = re.sub(r"<[^>]+>", " ", raw).strip()
-        stripped = re.sub(r"\s+", " ", stripped)
-        if not stripped:
-            data[field] = None
-
-    # Fee field: also strip HTML tags for display (description/directions use | safe)
-    if data.get("facility_use_fee"):
-        raw_fee = data["facility_use_fee"]
-        clean_fee = re.sub(r"<[^>]+>", " ", raw_fee).strip()
-        data["facility_use_fee"] = re.sub(r"\s+", " ", clean_fee)
+        WHERE r.facility_id IN (SELECT value FROM json_each(?))
+    """.format(addr_join=PREFERRED_ADDRESS_JOIN), (ids,)).fetchall()
+
+    facilities = {}
+    for row in rows:
+        data = dict(row)
+
+        # Null out fields that are empty-but-truthy HTML (e.g. <ul><li></li></ul>)
+        for field in ("facility_description", "facility_directions", "facility_use_fee"):
+            raw = data.get(field) or ""
+            stripped = re.sub(r"<[^>]+>", " ", raw).strip()
+            stripped = re.sub(r"\s+", " ", stripped)
+            if not stripped:
+                data[field] = None
+
+        # Fee field: also strip HTML tags for display (description/directions use | safe)
+        if data.get("facility_use_fee"):
+            raw_fee = data["facility_use_fee"]
+            clean_fee = re.sub(r"<[^>]+>", " ", raw_fee).strip()
+            data["facility_use_fee"] = re.sub(r"\s+", " ", clean_fee)
+
+        data["tags"] = {}
+        data["tag_list"] = []
+        data["activities"] = []
+        data["photos"] = []
+        facilities[data["facility_id"]] = data
+    if not facilities:
+        return facilities
+    # Only the ids that exist from here on.
+    ids = _json_list(list(facilities))
 
     # Tags grouped by category
     tags = conn.execute("""
-        SELECT tag, tag_category, display_order
+        SELECT facility_id, tag, tag_category, display_order
         FROM n_facility_tags
-        WHERE facility_id = ?
-        ORDER BY display_order, tag
-    """, (facility_id,)).fetchall()
-
-    tag_groups = {}
+        WHERE facility_id IN (SELECT value FROM json_each(?))
+        ORDER BY facility_id, display_order, tag
+    """, (ids,)).fetchall()
     for t in tags:
-        cat = t["tag_category"]
-        if cat not in tag_groups:
-            tag_groups[cat] = []
-        tag_groups[cat].append(t["tag"])
-
-    data["tags"] = tag_groups
-    data["tag_list"] = [t["tag"] for t in tags]
+        data = facilities[t["facility_id"]]
+        data["tags"].setdefault(t["tag_category"], []).append(t["tag"])
+        data["tag_list"].append(t["tag"])
 
     # Activities
     activities = conn.execute("""
-        SELECT activity_name FROM facility_activities
-        WHERE facility_id = ?
-        ORDER BY activity_name
-    """, (facility_id,)).fetchall()
-    data["activities"] = [a["activity_name"] for a in activities]
-
-    # Photos
+        SELECT facility_id, activity_name FROM facility_activities
+        WHERE facility_id IN (SELECT value FROM json_each(?))
+        ORDER BY facility_id, activity_name
+    """, (ids,)).fetchall()
+    for a in activities:
+        facilities[a["facility_id"]]["activities"].append(a["activity_name"])
+
+    # Photos: the first FACILITY_PHOTO_LIMIT per facility, primary first.
     photos = conn.execute("""
-        SELECT m.url, m.title, m.description
-        FROM media m
-        JOIN campsites c ON m.entity_id = c.campsite_id
-        WHERE c.facility_id = ?
-          AND m.entity_type = 'Campsite'
-          AND m.media_type = 'Image'
-        ORDER BY m.is_primary DESC
-        LIMIT 12
-    """, (facility_id,)).fetchall()
-    data["photos"] = [dict(ph) for ph in photos]
-
-    return data
+        SELECT facility_id, url, title, description FROM (
+            SELECT c.facility_id, m.url, m.title, m.description,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY c.facility_id
+                       ORDER BY m.is_primary DESC, m.entity_media_id
+                   ) AS n
+            FROM media m
+            JOIN campsites c ON m.entity_id = c.campsite_id
+            WHERE c.facility_id IN (SELECT value FROM json_each(?))
+              AND m.entity_type = 'Campsite'
+              AND m.media_type = 'Image'
+        )
+        WHERE n <= ?
+        ORDER BY facility_id, n
+    """, (ids, FACILITY_PHOTO_LIMIT)).fetchall()
+    for ph in photos:
+        facilities[ph["facility_id"]]["photos"].append(
+            {"url": ph["url"], "title": ph["title"],
+             "description": ph["description"]})
+
+    return facilities
 
 
 # ------------------------------------------------------------------
 # Nearby facilities
 # ------------------------------------------------------------------
+# The nearby list only changes with the data, so prepare_db.py computes
+# every mappable facility's NEARBY_K nearest within NEARBY_RADIUS_MILES
+# once, into n_facility_nearby, and a page render reads its list back by
+# primary key. Any smaller k and radius is a prefix of that list: rows are
+# stored nearest first with their dot product, and cut with the same
+# dot >= cos(radius) test the live search uses, so the two give identical
+# answers. A larger k or radius, a facility with no stored rows, or a
+# database built before the table existed gets the live search
+# (_FacilityIndex.nearest) instead.
+#
+# No KD-tree: the index's box lookup already narrows each facility to the
+# few candidates in range, and the exact dot products are three
+# multiply-adds each, so the whole table is seconds of pipeline time.
+
+NEARBY_K = 25
+NEARBY_RADIUS_MILES = 100
+
+
+def nearby_table(conn):
+    """Rows of n_facility_nearby: (facility_id, rank, neighbor_id, dot)."""
+    index = _FacilityIndex(conn)
+    for r in index.rows:
+        hits = index.nearest(r["facility_id"], r["latitude"], r["longitude"],
+                             NEARBY_RADIUS_MILES, NEARBY_K)
+        for rank, (dot, i) in enumerate(hits):
+            yield r["facility_id"], rank, index.rows[i]["facility_id"], dot
+
+
+def _stored_nearby(conn, index, facility_id, radius_miles, limit):
+    """nearest()-style [(dot, row)] from n_facility_nearby, or None."""
+    if radius_miles > NEARBY_RADIUS_MILES or limit > NEARBY_K:
+        return None
+    try:
+        rows = conn.execute("""
+            SELECT neighbor_id, dot FROM n_facility_nearby
+            WHERE facility_id = ? ORDER BY rank
+        """, (facility_id,)).fetchall()
+    except sqlite3.OperationalError:
+        return None     # built before the table existed
+    if not rows:
+        return None
+    min_dot = math.cos(min(radius_miles / EARTH_RADIUS_MILES, math.pi))
+    hits = []
+    for neighbor_id, dot in rows:
+        i = index.position.get(neighbor_id)
+        if i is None:
+            return None     # table and index disagree; trust the index
+        if dot >= min_dot:
+            hits.append((dot, i))
+    return hits[:limit]
+
 
 def get_nearby(conn, facility_id, lat, lon, radius_miles=50, limit=8):
     if not lat or not lon:
         return []
 
-    lat_delta = radius_miles / 69.0
-    lon_delta = radius_miles / (69.0 * max(math.cos(math.radians(lat)), 0.01))
+    index = facility_index(conn)
+    hits = None
+    own = index.position.get(facility_id)
+    # The table was computed from the index row's coordinates.
+    if own is not None and (index.rows[own]["latitude"],
+                            index.rows[own]["longitude"]) == (lat, lon):
+        hits = _stored_nearby(conn, index, facility_id, radius_miles, limit)
+    if hits is None:
+        hits = index.nearest(facility_id, lat, lon, radius_miles, limit)
+    return index.nearby_rows(hits)
 
-    haversine = """(3959 * acos(
-                min(1.0, max(-1.0,
-                    cos(radians(?)) * cos(radians(r.latitude))
-                    * cos(radians(r.longitude) - radians(?))
-                    + sin(radians(?)) * sin(radians(r.latitude))
-                ))))"""
 
-    rows = conn.execute("""
-        SELECT
-            r.facility_id, r.facility_name, r.org_abbrev, r.camping_type,
-            r.latitude, r.longitude, r.max_rv_length, r.total_campsites,
-            c.road_access, c.boondock_accessibility,
-            fa.city, fa.state_code,
-            {} AS distance_miles
-        FROM n_facility_rollup r
-        JOIN n_facility_conditions c ON r.facility_id = c.facility_id
-        {addr_join}
-        WHERE r.facility_id != ?
-          AND r.coords_valid = 1
-          AND r.facility_name IS NOT NULL AND r.facility_name <> ''
-          AND r.camping_type IN ('DEVELOPED', 'PRIMITIVE', 'DISPERSED')
-          AND r.latitude BETWEEN ? AND ?
-          AND r.longitude BETWEEN ? AND ?
-          AND {} <= ?
-        ORDER BY distance_miles ASC
-        LIMIT ?
-    """.format(haversine, haversine, addr_join=PREFERRED_ADDRESS_JOIN),
-        (lat, lon, lat,
-         facility_id,
-         lat - lat_delta, lat + lat_delta,
-         lon - lon_delta, lon + lon_delta,
-         lat, lon, lat,
-         radius_miles, limit)).fetchall()
+def facility_nearby(conn, facility_id, radius_miles=50, limit=8):
+    """get_nearby for a facility id alone.
 
-    return [dict(r) for r in rows]
+    None if there is no such facility (as get_facility would say). One
+    that exists but isn't on the map -- no usable coordinates -- has no
+    neighbours: [].
+    """
+    index = facility_index(conn)
+    own = index.position.get(facility_id)
+    if own is None:
+        exists = conn.execute("""
+            SELECT 1 FROM n_facility_rollup r
+            JOIN n_facility_conditions c ON r.facility_id = c.facility_id
+            WHERE r.facility_id = ?
+        """, (facility_id,)).fetchone()
+        return [] if exists else None
+    row = index.rows[own]
+    return get_nearby(conn, facility_id, row["latitude"], row["longitude"],
+                      radius_miles, limit)
 
 
 # ------------------------------------------------------------------
 # Helpers
 # ------------------------------------------------------------------
 
-def _attach_top_tags(conn, results, max_tags=4):
-    """Attach top N tags to each result dict (avoids N+1 query)."""
-    if not results:
-        return
-
-    fac_ids = [r["facility_id"] for r in results]
-    placeholders = ",".join("?" * len(fac_ids))
-
-    rows = conn.execute("""
-        SELECT facility_id, tag, tag_category
-        FROM n_facility_tags
-        WHERE facility_id IN ({})
-        ORDER BY display_order, tag
-    """.format(placeholders), fac_ids).fetchall()
-
-    tag_map = {}
-    for r in rows:
-        fid = r["facility_id"]
-        if fid not in tag_map:
-            tag_map[fid] = []
-        tag_map[fid].append(r["tag"])
-
+def _attach_top_tags(results, max_tags=4):
+    """Attach top N tags to each result dict, decoded from its tag_mask."""
     for r in results:
-        all_tags = tag_map.get(r["facility_id"], [])
+        all_tags = tags_from_mask(r.pop("tag_mask"))
         r["top_tags"] = all_tags[:max_tags]
         r["tag_count"] = len(all_tags)
 
@@ -507,31 +1364,227 @@ def search_pins_by_bounds(conn, south, north, west, east,
                           hookups=None, min_rv_length=None, excludes=None,
                           seasonal_status=None, fire_status=None,
                           reservable=None, tag_filters=None):
-    """Lightweight bounding-box query for map pins. No LIMIT — bbox is the constraint."""
-    if not camping_types:
-        camping_types = list(DEFAULT_CAMPING_TYPES)
+    """Lightweight bounding-box query for map pins. No LIMIT — bbox is the constraint.
 
-    where_sql, params = _bounds_where(
-        south, north, west, east, camping_types, agencies,
-        road_access, styles, hookups, min_rv_length, excludes,
+    Answered from the in-process facility index, not SQL. Returns only what
+    the map renders: the hookup flags and road_access used to ride along in
+    every pin and were used by nothing -- the map's hookup and road filters
+    are applied server-side from query params, not from pin fields.
+    """
+    index = facility_index(conn)
+    return index.pins(index.match(
+        south, north, west, east, camping_types=camping_types,
+        agencies=agencies, road_access=road_access,
         seasonal_status=seasonal_status, fire_status=fire_status,
-        reservable=reservable, tag_filters=tag_filters)
+        styles=styles, hookups=hookups, reservable=reservable,
+        min_rv_length=min_rv_length, excludes=excludes,
+        tag_filters=tag_filters))
 
-    # Only what the map renders. The hookup flags and road_access rode along in
-    # every pin and were used by nothing -- the map's hookup and road filters
-    # are applied server-side from query params, not from pin fields.
-    sql = """
-        SELECT
-            r.facility_id, r.facility_name, r.latitude, r.longitude,
-            r.camping_type, r.total_campsites, r.org_abbrev,
-            r.max_rv_length,
-            c.seasonal_status
-        FROM n_facility_rollup r
-        JOIN n_facility_conditions c ON r.facility_id = c.facility_id
-    """ + where_sql
 
-    rows = conn.execute(sql, params).fetchall()
-    return [dict(r) for r in rows]
+# ------------------------------------------------------------------
+# Pin tiles
+# ------------------------------------------------------------------
+# /api/pins/<z>/<x>/<y>: the map's pins cut into standard 256px Web
+# Mercator (XYZ) tiles. At CLUSTER_MAX_ZOOM and below, a tile is clustered
+# on the server -- every 32px cell with more than one pin becomes one
+# point with a count -- so a continental view is a few hundred points
+# instead of every facility for the browser to cluster. Above it, a tile
+# is the raw pins. Cells never straddle tiles, so each tile stands alone
+# and is the same bytes for every visitor: cacheable for as long as the
+# database build lives (see build_id).
+
+CLUSTER_MAX_ZOOM = 10
+TILE_MAX_ZOOM = 18
+_TILE_SIZE = 256
+_CLUSTER_CELL = 32          # px; 8 x 8 cells per tile
+_MERCATOR_MAX_LAT = 85.0511287798066
+
+
+def _world_px(lat, lon, z):
+    """Web Mercator pixel coordinates of a point at zoom z."""
+    world = _TILE_SIZE * 2 ** z
+    lat = max(-_MERCATOR_MAX_LAT, min(_MERCATOR_MAX_LAT, lat))
+    sin_lat = math.sin(math.radians(lat))
+    px = (lon + 180.0) / 360.0 * world
+    py = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * world
+    return px, py
+
+
+def tile_bounds(z, x, y):
+    """(south, north, west, east) of XYZ tile (z, x, y), in degrees."""
+    n = 2 ** z
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return lat(y + 1), lat(y), x / n * 360.0 - 180.0, (x + 1) / n * 360.0 - 180.0
+
+
+def get_pin_tile(conn, z, x, y, **filters):
+    """The pins of one map tile, clustered at CLUSTER_MAX_ZOOM and below.
+
+    A pin belongs to exactly one tile: the one its projected pixel falls
+    in, so a pin on a tile edge isn't drawn twice. Clustered tiles return
+    pin dicts for lone pins and, per crowded cell,
+    {"count", "latitude", "longitude", "south", "north", "west", "east"}:
+    the members' centroid and their bounding box (what a click zooms to).
+    Takes the same filters as search_pins_by_bounds.
+    """
+    south, north, west, east = tile_bounds(z, x, y)
+    # Pad past the edges; the pixel test below makes the cut exact.
+    pad = 1e-9
+    index = facility_index(conn)
+    mask = index.match(south - pad, north + pad, west - pad, east + pad,
+                       **filters)
+
+    cells = {}
+    for i in _set_bits(mask):
+        r = index.rows[i]
+        px, py = _world_px(r["latitude"], r["longitude"], z)
+        if int(px // _TILE_SIZE) != x or int(py // _TILE_SIZE) != y:
+            continue
+        cell = (int(py // _CLUSTER_CELL), int(px // _CLUSTER_CELL))
+        if z > CLUSTER_MAX_ZOOM:
+            cell = i        # one "cell" per pin, kept in index order
+        cells.setdefault(cell, []).append(r)
+
+    features = []
+    for cell in sorted(cells):
+        members = cells[cell]
+        if len(members) == 1:
+            features.append({col: members[0][col] for col in _PIN_COLUMNS})
+            continue
+        lats = [r["latitude"] for r in members]
+        lons = [r["longitude"] for r in members]
+        features.append({
+            "count": len(members),
+            "latitude": sum(lats) / len(lats),
+            "longitude": sum(lons) / len(lons),
+            "south": min(lats), "north": max(lats),
+            "west": min(lons), "east": max(lons),
+        })
+    return features
+
+
+# The default-filter tiles every first visit loads are rendered once, at
+# build time (prepare_db.py), into n_pin_tile -- and exported as static
+# files Caddy can serve without the app (export_tiles.py).
+PRERENDERED_TILE_ZOOMS = range(3, CLUSTER_MAX_ZOOM + 1)
+
+# Stored tiles are only served while they match this db.py
+# (prerendered_tiles_current).
+
+
+def dump_json(obj):
+    """JSON bytes as the pin endpoints serve them: compact, sorted keys, ASCII."""
+    return (json.dumps(obj, sort_keys=True, separators=(",", ":")) + "\n").encode()
+
+
+_EMPTY_TILE = dump_json([])
+
+# /api/pins?format=columns: the same pins as parallel arrays, for the
+# map's own use. A pin dict repeats nine key names; here each name appears
+# once, the three enum-like columns become small indexes into a per-response
+# dictionary, and coordinates become integer millionths of a degree,
+# delta-encoded in row order. Rows come latitude-sorted from the index, so
+# the latitude deltas are tiny. Millionths (~11cm) rather than anything
+# coarser so a decoded pin sits on the same side of a 4-decimal viewport
+# edge as the real one -- the map counts pins against that edge.
+PIN_COORD_SCALE = 1000000
+_PIN_DICT_COLUMNS = ["camping_type", "org_abbrev", "seasonal_status"]
+
+
+def pins_to_columns(pins):
+    """Columnar encoding of a pin list; static/map.js decodePins reverses it."""
+    out = {"format": "columns", "n": len(pins), "scale": PIN_COORD_SCALE,
+           "dict": {}}
+    for col in _PIN_DICT_COLUMNS:
+        codes, values = {}, []
+        for p in pins:
+            values.append(codes.setdefault(p[col], len(codes)))
+        out["dict"][col] = list(codes)
+        out[col] = values
+    for col in ("latitude", "longitude"):
+        prev, deltas = 0, []
+        for p in pins:
+            q = round(p[col] * PIN_COORD_SCALE)
+            deltas.append(q - prev)
+            prev = q
+        out[col] = deltas
+    for col in _PIN_COLUMNS:
+        if col not in out:
+            out[col] = [p[col] for p in pins]
+    return out
+
+
+def pin_tile_pyramid(conn):
+    """Yield (z, x, y, body) for every non-empty default-filter tile in
+    PRERENDERED_TILE_ZOOMS. Tiles not yielded are empty."""
+    index = facility_index(conn)
+    rows = [index.rows[i] for i in _set_bits(index.match(-90, 90, -361, 361))]
+    for z in PRERENDERED_TILE_ZOOMS:
+        tiles = set()
+        for r in rows:
+            px, py = _world_px(r["latitude"], r["longitude"], z)
+            tiles.add((int(px // _TILE_SIZE), int(py // _TILE_SIZE)))
+        for x, y in sorted(tiles):
+            yield z, x, y, dump_json(get_pin_tile(conn, z, x, y))
+
+
+def prerendered_tiles_current(conn):
+    """Whether n_pin_tile was rendered by this db.py (SOURCE_VERSION)."""
+    return _written_by_this_code(conn, "pin_tile_code")
+
+
+def prerendered_tile(conn, z, x, y):
+    """A default-filter tile's body from n_pin_tile; None if not prerendered
+    (or prerendered by different code)."""
+    if z not in PRERENDERED_TILE_ZOOMS or not prerendered_tiles_current(conn):
+        return None
+    try:
+        row = conn.execute(
+            "SELECT body FROM n_pin_tile WHERE z = ? AND x = ? AND y = ?",
+            (z, x, y)).fetchone()
+    except sqlite3.OperationalError:
+        return None     # built before the pyramid existed
+    return row[0] if row else _EMPTY_TILE
+
+
+_build = (None, None)
+
+
+def build_id(conn):
+    """Short id of the database build: when prepare_db.py last ran.
+
+    Part of every tile URL (with the code version, app.tile_version), so
+    a tile's bytes never change under its URL and the edge can keep it
+    forever; a new build is a new set of URLs.
+    """
+    global _build
+    gen, bid = _build
+    if gen != _generation:
+        row = None
+        try:
+            row = conn.execute(
+                "SELECT value FROM n_meta WHERE key = 'phase4_prep_at'"
+            ).fetchone()
+        except sqlite3.OperationalError:
+            pass
+        bid = re.sub(r"\D", "", row[0]) if row and row[0] else "0"
+        _build = (_generation, bid)
+    return bid
+
+
+def build_time(conn):
+    """The build id as an aware UTC datetime, or None if there isn't one.
+
+    phase4_prep_at is written in UTC, so its digits are YYYYMMDDHHMMSS.
+    """
+    try:
+        return datetime.strptime(build_id(conn), "%Y%m%d%H%M%S").replace(
+            tzinfo=timezone.utc)
+    except ValueError:
+        return None
 
 
 def _bounds_where(south, north, west, east, camping_types, agencies,
@@ -540,20 +1593,18 @@ def _bounds_where(south, north, west, east, camping_types, agencies,
                   reservable=None, tag_filters=None):
     """Shared WHERE clause for the bbox pins/list/count queries.
 
-    Used by search_pins_by_bounds, search_by_bounds, and get_bounds_count so
-    the map pins, the results list, and the count pill always agree. Filters
-    come from _filter_sql, the one vocabulary shared with the state and
-    location paths. Requires n_facility_rollup aliased as "r" and
-    n_facility_conditions as "c". Returns (sql, params).
+    Used by search_by_bounds. The pins and the count pill come from the
+    in-process index (_FacilityIndex.match), which mirrors this clause so
+    the map and the results list always agree. Filters come from
+    _filter_sql, the one vocabulary shared with the state and location
+    paths. Follows _GEO_FROM. Returns (sql, params).
     """
+    geo_sql, params = _geo_sql(south, north, west, east)
     sql = """
-        WHERE r.coords_valid = 1
-          AND r.facility_name IS NOT NULL AND r.facility_name <> ''
-          AND r.latitude BETWEEN ? AND ?
-          AND r.longitude BETWEEN ? AND ?
-          AND r.camping_type IN ({})
-    """.format(','.join('?' * len(camping_types)))
-    params = [south, north, west, east] + list(camping_types)
+        WHERE {}
+          AND s.camping_type IN (SELECT value FROM json_each(?))
+    """.format(geo_sql)
+    params.append(_json_list(camping_types))
 
     f_sql, f_params = _filter_sql(
         agencies=agencies, road_access=road_access,
@@ -571,14 +1622,15 @@ def search_by_bounds(conn, south, north, west, east,
                      camping_types=None, agencies=None, road_access=None,
                      styles=None, hookups=None, min_rv_length=None,
                      excludes=None, seasonal_status=None, fire_status=None,
-                     reservable=None, tag_filters=None, limit=25, offset=0):
+                     reservable=None, tag_filters=None, limit=25, offset=0,
+                     cursor=None):
     """Card-shaped results for the map's viewport list.
 
     Same column list as search_by_state, filtered by the same WHERE clause
     as search_pins_by_bounds (via _bounds_where) so the list matches the
     pins exactly. Ordered by total_campsites DESC with facility_id as a
     tiebreak: without it OFFSET pagination is unstable and rows silently
-    duplicate/drop between pages.
+    duplicate/drop between pages. Takes a cursor like search_by_state.
     """
     if not camping_types:
         camping_types = list(DEFAULT_CAMPING_TYPES)
@@ -589,33 +1641,22 @@ def search_by_bounds(conn, south, north, west, east,
         seasonal_status=seasonal_status, fire_status=fire_status,
         reservable=reservable, tag_filters=tag_filters)
 
+    if cursor:
+        seek_sql, seek_params = _rank_seek_sql(cursor)
+        where_sql += seek_sql
+        params.extend(seek_params)
+
     sql = """
-        SELECT
-            r.facility_id, r.facility_name, r.org_abbrev, r.camping_type,
-            r.latitude, r.longitude, r.total_campsites,
-            r.rv_type_sites, r.sites_accepting_rv,
-            r.has_full_hookup, r.has_electric_hookup,
-            r.has_water_hookup, r.has_sewer_hookup, r.max_amps,
-            r.max_rv_length, r.pullthrough_sites, r.backin_sites,
-            r.surface_predominant, r.reservable, r.full_hookup_sites,
-            r.electric_hookup_sites, r.camping_type_confidence,
-            c.road_access, c.driveway_surface, c.seasonal_status,
-            c.fire_status, c.elevation_ft, c.boondock_accessibility,
-            fa.city, fa.state_code,
-            p.photo_url
-        FROM n_facility_rollup r
-        JOIN n_facility_conditions c ON r.facility_id = c.facility_id
-        {addr_join}
-        LEFT JOIN n_facility_photo p ON r.facility_id = p.facility_id
-    """.format(addr_join=PREFERRED_ADDRESS_JOIN) + where_sql + """
-        ORDER BY r.total_campsites DESC, r.facility_id
+        SELECT {cols}
+    """.format(cols=_CARD_SELECT) + _GEO_FROM + where_sql + """
+        ORDER BY s.total_campsites DESC, s.facility_id
         LIMIT ? OFFSET ?
     """
     params.extend([limit, offset])
 
     rows = conn.execute(sql, params).fetchall()
     results = [dict(r) for r in rows]
-    _attach_top_tags(conn, results)
+    _attach_top_tags(results)
     return results
 
 
@@ -626,25 +1667,18 @@ def get_bounds_count(conn, south, north, west, east,
                      reservable=None, tag_filters=None):
     """Unpaginated total for a bbox search.
 
-    WHERE clause is identical to search_pins_by_bounds (via _bounds_where),
-    so the map count pill, the panel count, and pagination never disagree.
+    Counted from the same in-process index as search_pins_by_bounds, whose
+    masks mirror _bounds_where, so the map count pill, the panel count, and
+    pagination never disagree.
     """
-    if not camping_types:
-        camping_types = list(DEFAULT_CAMPING_TYPES)
-
-    where_sql, params = _bounds_where(
-        south, north, west, east, camping_types, agencies,
-        road_access, styles, hookups, min_rv_length, excludes,
+    mask = facility_index(conn).match(
+        south, north, west, east, camping_types=camping_types,
+        agencies=agencies, road_access=road_access,
         seasonal_status=seasonal_status, fire_status=fire_status,
-        reservable=reservable, tag_filters=tag_filters)
-
-    sql = """
-        SELECT COUNT(*)
-        FROM n_facility_rollup r
-        JOIN n_facility_conditions c ON r.facility_id = c.facility_id
-    """ + where_sql
-
-    return conn.execute(sql, params).fetchone()[0]
+        styles=styles, hookups=hookups, reservable=reservable,
+        min_rv_length=min_rv_length, excludes=excludes,
+        tag_filters=tag_filters)
+    return bin(mask).count("1")
 
 
 def get_search_count(conn, state_codes=None, lat=None, lon=None,
@@ -653,50 +1687,56 @@ def get_search_count(conn, state_codes=None, lat=None, lon=None,
                      road_access=None, seasonal_status=None, fire_status=None,
                      styles=None, hookups=None, reservable=None,
                      min_rv_length=None, excludes=None):
-    """Get total count for pagination (without LIMIT/OFFSET)."""
+    """Get total count for pagination (without LIMIT/OFFSET).
+
+    Shares its cache with the with_total searches. The location branch
+    counts the radius, not its bounding box: it used to count the box, so
+    the total ran ~30% high and Load More offered pages that came back short.
+    """
     if isinstance(state_codes, str):
         state_codes = [state_codes]
     if not camping_types:
         camping_types = list(DEFAULT_CAMPING_TYPES)
+    filters = dict(
+        agencies=agencies, road_access=road_access,
+        seasonal_status=seasonal_status, fire_status=fire_status,
+        styles=styles, hookups=hookups, reservable=reservable,
+        min_rv_length=min_rv_length, excludes=excludes,
+        tag_filters=tag_filters)
 
     if state_codes:
-        sql = """
-            SELECT COUNT(DISTINCT r.facility_id)
-            FROM n_facility_rollup r
-            JOIN n_facility_conditions c ON r.facility_id = c.facility_id
-            {addr_join}
-            WHERE fa.state_code IN ({})
-              AND r.camping_type IN ({})
-        """.format(','.join('?' * len(state_codes)), ','.join('?' * len(camping_types)),
-                   addr_join=PREFERRED_ADDRESS_JOIN)
-        params = list(state_codes) + camping_types
-    elif lat is not None and lon is not None:
-        lat_delta = radius_miles / 69.0
-        lon_delta = radius_miles / (69.0 * max(math.cos(math.radians(lat)), 0.01))
+        state_sql, params = _state_sql(state_codes)
         sql = """
             SELECT COUNT(*)
-            FROM n_facility_rollup r
-            JOIN n_facility_conditions c ON r.facility_id = c.facility_id
-            WHERE r.coords_valid = 1
-              AND r.latitude BETWEEN ? AND ?
-              AND r.longitude BETWEEN ? AND ?
-              AND r.camping_type IN ({})
-        """.format(','.join('?' * len(camping_types)))
-        params = [lat - lat_delta, lat + lat_delta,
-                  lon - lon_delta, lon + lon_delta] + camping_types
+            FROM n_search_card s
+            WHERE {}
+              AND s.camping_type IN (SELECT value FROM json_each(?))
+        """.format(state_sql)
+        params.append(_json_list(camping_types))
+    elif lat is not None and lon is not None:
+        geo_sql, params = _geo_sql(*_radius_box(lat, lon, radius_miles))
+        dot_sql, dot_params, min_dot = _proximity_sql(lat, lon, radius_miles)
+        sql = "SELECT COUNT(*)" + _GEO_FROM + """
+            WHERE {}
+              AND s.camping_type IN (SELECT value FROM json_each(?))
+              AND {} >= ?
+        """.format(geo_sql, dot_sql)
+        params += [_json_list(camping_types)] + dot_params + [min_dot]
     else:
         return 0
 
-    f_sql, f_params = _filter_sql(
-        agencies=agencies, road_access=road_access,
-        seasonal_status=seasonal_status, fire_status=fire_status,
-        styles=styles, hookups=hookups, reservable=reservable,
-        min_rv_length=min_rv_length, excludes=excludes,
-        tag_filters=tag_filters)
+    key = _count_key(state_codes, lat, lon, radius_miles, camping_types, filters)
+    total = _totals.get(key)
+    if total is not None:
+        return total
+
+    f_sql, f_params = _filter_sql(**filters)
     sql += f_sql
     params.extend(f_params)
 
-    return conn.execute(sql, params).fetchone()[0]
+    total = conn.execute(sql, params).fetchone()[0]
+    _totals.put(key, total)
+    return total
 
 
 # ------------------------------------------------------------------
@@ -721,18 +1761,18 @@ def all_facility_ids(conn):
 
 
 def facilities_for_state(conn, state_code, limit=2000):
-    """Named campable facilities in one state, for the state index page."""
-    sql = """
-        SELECT r.facility_id, r.facility_name, r.org_abbrev, r.camping_type,
-               r.total_campsites, r.max_rv_length, fa.city
-        FROM n_facility_rollup r
-        {addr_join}
-        WHERE r.facility_name IS NOT NULL AND r.facility_name <> ''
-          AND r.camping_type IN ({types})
-          AND fa.state_code = ?
-        ORDER BY r.facility_name
+    """Named campable facilities in one state, for the state index page.
+
+    The card table holds exactly the facilities search can return, so the
+    page lists what the state's search (and its count) covers, read in
+    name order straight off idx_nsc_state_name.
+    """
+    rows = conn.execute("""
+        SELECT s.facility_id, s.facility_name, s.org_abbrev, s.camping_type,
+               s.total_campsites, s.max_rv_length, s.city
+        FROM n_search_card s
+        WHERE s.state_code = ?
+        ORDER BY s.facility_name
         LIMIT ?
-    """.format(addr_join=PREFERRED_ADDRESS_JOIN,
-               types=",".join("'%s'" % t for t in DEFAULT_CAMPING_TYPES))
-    rows = conn.execute(sql, (state_code, limit)).fetchall()
+    """, (state_code, limit)).fetchall()
     return [dict(r) for r in rows]
@@ -37,8 +37,8 @@ if [[ $WITH_DB -eq 1 ]]; then
 fi
 
 echo "==> Packaging app files..."
-tar czf /tmp/fedcamp.tar.gz app.py db.py stats.py rebuild_state_cache.py \
-    templates/ static/
+tar czf /tmp/fedcamp.tar.gz app.py asgi.py db.py cache.py compress.py ratelimit.py stats.py rebuild_state_cache.py \
+    export_tiles.py prerender.py gunicorn.conf.py templates/ static/
 
 echo "==> Uploading app tarball..."
 $SCP /tmp/fedcamp.tar.gz "$HOST:~"
@@ -49,9 +49,12 @@ if [[ $WITH_DB -eq 1 ]]; then
 fi
 
 echo "==> Snapshotting current release for rollback..."
-$SSH "$HOST" "cd $REMOTE_DIR && tar czf ~/fedcamp-rollback-$STAMP.tar.gz app.py db.py stats.py templates/ static/"
+# --ignore-failed-read: a module this release adds doesn't exist on the server
+# yet, and a missing file mustn't abort the deploy.
+$SSH "$HOST" "cd $REMOTE_DIR && tar czf ~/fedcamp-rollback-$STAMP.tar.gz --ignore-failed-read app.py asgi.py db.py cache.py compress.py ratelimit.py stats.py export_tiles.py prerender.py gunicorn.conf.py templates/ static/"
 
-# Stop before swapping. The app opens a SQLite connection per request, and
+# Stop before swapping. Workers hold a pooled SQLite connection per thread
+# (they'd reopen on the new file, but only on their next request), and
 # replacing ridb.db while the OLD ridb.db-wal/-shm remain in place is a known
 # corruption path: SQLite binds the WAL by filename, not to file contents, so
 # it can try to recover the old database's frames into the new file. The app
@@ -97,6 +100,15 @@ $SSH "$HOST" "cd $REMOTE_DIR && ./venv/bin/python rebuild_state_cache.py" \
          echo "Roll back: $SSH $HOST 'cd $REMOTE_DIR && tar xzf ~/fedcamp-rollback-$STAMP.tar.gz && sudo systemctl start fedcamp'" >&2
          exit 1; }
 
+# The unfiltered map's tiles, prerendered by prepare_db.py, go out as static
+# files so Caddy answers a first visit's map without gunicorn (see README,
+# "Pin tiles"). Not fatal: the app serves the same tiles itself.
+echo "==> Exporting pin tiles..."
+$SSH "$HOST" "sudo mkdir -p /var/www/fedcamp/tiles \
+    && sudo chown ubuntu: /var/www/fedcamp/tiles \
+    && cd $REMOTE_DIR && ./venv/bin/python export_tiles.py /var/www/fedcamp/tiles" \
+    || echo "WARNING: tile export failed; the app will serve tiles itself." >&2
+
 echo "==> Starting gunicorn..."
 $SSH "$HOST" "sudo systemctl start fedcamp"
 
@@ -122,6 +134,20 @@ if ! $SSH "$HOST" 'for i in $(seq 1 15); do
     exit 1
 fi
 echo "    origin OK"
+# gunicorn.conf.py warms the app before the workers fork, so this is what a
+# visitor gets straight after a deploy -- it should not be a cold number.
+$SSH "$HOST" "curl -sS -o /dev/null -w '    warm latency: /campgrounds %{time_total}s, /api/states ' http://127.0.0.1:5000/campgrounds \
+    && curl -sS -o /dev/null -w '%{time_total}s\n' http://127.0.0.1:5000/api/states" || true
+
+# Facility, state and sitemap pages as static files for Caddy (see README,
+# "Deployment"). Run with the app up -- it takes a few seconds of both
+# cores, and the old set keeps being served until the new one is swapped
+# in. Not fatal: the app serves every one of these pages itself.
+echo "==> Prerendering pages..."
+$SSH "$HOST" "sudo mkdir -p /var/www/fedcamp/pages \
+    && sudo chown ubuntu: /var/www/fedcamp/pages \
+    && cd $REMOTE_DIR && nice ./venv/bin/python prerender.py /var/www/fedcamp/pages" \
+    || echo "WARNING: prerender failed; the app will serve those pages itself." >&2
 
 # The origin check alone would not have caught the Caddy failure that took the
 # site down for 5 days in Jul 2026 — gunicorn was healthy throughout. Verify
@@ -0,0 +1,74 @@
+"""Write the prerendered map pin tiles out as static files.
+
+prepare_db.py renders the unfiltered map's tiles (zooms 3-10) into
+n_pin_tile. This copies them to OUT_DIR/<version>/<z>/<x>/<y>.json -- the
+same paths the app serves them at under /tiles/ -- so Caddy can answer a
+first visit's map from disk without touching gunicorn. Tiles missing from
+disk (the empty ones) fall through to the app, which has them too.
+
+The version (app.tile_version: the build and the code) is part of the path
+and the files are immutable, so a new build or release is written next to
+the old one and swapped in whole; other versions' directories are removed
+afterwards. Tiles rendered by a different db.py than the one shipping are
+not exported: the app renders its own instead (db.prerendered_tiles_current).
+
+Usage:
+    python export_tiles.py OUT_DIR [path-to-db]     # db defaults to ridb.db
+"""
+import os
+import shutil
+import sqlite3
+import sys
+
+import db
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__, file=sys.stderr)
+        return 2
+    out_dir = sys.argv[1]
+    path = sys.argv[2] if len(sys.argv) > 2 else db.DB_PATH
+
+    db.DB_PATH = path
+    import app
+
+    conn = sqlite3.connect(path)
+    version = app.tile_version(conn)
+    try:
+        rows = conn.execute("SELECT z, x, y, body FROM n_pin_tile").fetchall()
+    except sqlite3.OperationalError:
+        print("ERROR: no n_pin_tile table — run prepare_db.py first",
+              file=sys.stderr)
+        conn.close()
+        return 1
+    if not db.prerendered_tiles_current(conn):
+        print("ERROR: n_pin_tile was rendered by a different db.py — "
+              "re-run prepare_db.py (the app renders tiles itself meanwhile)",
+              file=sys.stderr)
+        conn.close()
+        return 1
+    conn.close()
+
+    os.makedirs(out_dir, exist_ok=True)
+    tmp_dir = os.path.join(out_dir, f".{version}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    for z, x, y, body in rows:
+        tile_dir = os.path.join(tmp_dir, str(z), str(x))
+        os.makedirs(tile_dir, exist_ok=True)
+        with open(os.path.join(tile_dir, f"{y}.json"), "wb") as f:
+            f.write(body)
+
+    final_dir = os.path.join(out_dir, version)
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.rename(tmp_dir, final_dir)
+    for name in os.listdir(out_dir):
+        if name != version:
+            shutil.rmtree(os.path.join(out_dir, name), ignore_errors=True)
+
+    print(f"{len(rows):,} tiles for version {version} -> {final_dir}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+"""
+gunicorn settings for production:
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The app is imported and warmed once, in the master (app.warm), before any
+worker exists: the facility index, the compiled templates, the sitemap and
+the static_v versions are built there and the workers fork with them
+already in memory, shared copy-on-write. The database file is read through
+once too, so the OS page cache every worker's mmap reads from is hot. So
+the first requests after a deploy -- the health check included -- are
+served warm.
+
+The master's SQLite connection is closed before the fork (a connection
+must never be used on both sides of one); each worker opens its own on
+its first request. Note that with preload_app a HUP reloads the config but
+not the code: deploy.sh stops and starts the service, which does.
+
+Without preload (FEDCAMP_PRELOAD=0), each worker warms itself instead,
+before it accepts a request.
+
+Warming is an optimisation, never a reason not to start: if it fails (no
+ridb.db yet, an old schema, one page raising) the error is logged and the
+server comes up cold, as it did before there was a warm step.
+"""
+
+import os
+import time
+
+bind = "127.0.0.1:5000"
+workers = 2
+preload_app = os.environ.get("FEDCAMP_PRELOAD", "1") != "0"
+
+
+def _warm(log):
+    import app
+    import db
+
+    t0 = time.perf_counter()
+    try:
+        timings = app.warm()
+    except Exception:
+        log.exception("warm failed; starting cold")
+        return
+    finally:
+        db.release_connection()
+    log.info("warmed in %.2fs (%s)", time.perf_counter() - t0,
+             ", ".join(f"{k} {v:.2f}s" for k, v in timings.items()))
+
+
+def when_ready(server):
+    # In the master, after the preloaded app is imported, before the fork.
+    if server.cfg.preload_app:
+        _warm(server.log)
+
+
+def post_worker_init(worker):
+    if not worker.cfg.preload_app:
+        _warm(worker.log)
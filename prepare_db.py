@@ -1,5 +1,7 @@
 """
-Phase 4 prep: Create app indexes, photo mapping table, and state cache.
+Phase 4 prep: Create app indexes, photo mapping table, preferred address
+table, search card table with its R*Tree spatial index, state cache, the
+nearby-facilities table, and the prerendered map pin tiles.
 
 Run once before starting the Flask app.
 
@@ -7,6 +9,7 @@ Usage:
     python prepare_db.py
 """
 
+import math
 import sqlite3
 import time
 from datetime import datetime, timezone
@@ -154,15 +157,182 @@ def main():
     print(f"  Fixed {fixes} rows, nulled {nulled} invalid rows")
 
     # ------------------------------------------------------------------
-    # 4. State cache table
+    # 4. Preferred address table (one row per facility)
     # ------------------------------------------------------------------
-    print("\n4. Building state cache...")
+    # Must run after step 3: the ranking prefers rows that carry a
+    # state_code, so it has to see the normalized values.
+    print("\n4. Building preferred address table...")
+
+    cur.execute("DROP TABLE IF EXISTS n_facility_address")
+    cur.execute("""
+        CREATE TABLE n_facility_address (
+            facility_id         TEXT PRIMARY KEY,
+            facility_address_id TEXT,
+            address_type        TEXT,
+            city                TEXT,
+            state_code          TEXT,
+            postal_code         TEXT,
+            street1             TEXT
+        )
+    """)
+    cur.execute("INSERT INTO n_facility_address " + db.PREFERRED_ADDRESS_SQL)
+    cur.execute("CREATE INDEX idx_nfa_state "
+                "ON n_facility_address(state_code, facility_id)")
+
+    addr_count = cur.execute("SELECT COUNT(*) FROM n_facility_address").fetchone()[0]
+    print(f"  {addr_count:,} facilities with a preferred address")
+
+    # ------------------------------------------------------------------
+    # 5. Search card table (one flattened row per campable facility)
+    # ------------------------------------------------------------------
+    # Everything a search result card shows, plus the columns the shared
+    # filters test, pre-joined so searches, counts and pins read one table.
+    # Only rows search can return: named, campable facilities.
+    print("\n5. Building search card table...")
+
+    cur.execute("DROP TABLE IF EXISTS n_search_card")
+    cur.execute("""
+        CREATE TABLE n_search_card (
+            card_id                 INTEGER PRIMARY KEY,
+            facility_id             TEXT NOT NULL UNIQUE,
+            facility_name           TEXT NOT NULL,
+            org_abbrev              TEXT,
+            camping_type            TEXT NOT NULL,
+            latitude                REAL,
+            longitude               REAL,
+            coords_valid            INTEGER,
+            sin_lat                 REAL,
+            cos_lat                 REAL,
+            sin_lon                 REAL,
+            cos_lon                 REAL,
+            total_campsites         INTEGER NOT NULL,
+            rv_type_sites           INTEGER,
+            sites_accepting_rv      INTEGER,
+            sites_accepting_tent    INTEGER,
+            walk_in_sites           INTEGER,
+            hike_in_sites           INTEGER,
+            boat_in_sites           INTEGER,
+            equestrian_sites        INTEGER,
+            has_full_hookup         INTEGER,
+            has_electric_hookup     INTEGER,
+            has_water_hookup        INTEGER,
+            has_sewer_hookup        INTEGER,
+            max_amps                INTEGER,
+            max_rv_length           INTEGER,
+            pullthrough_sites       INTEGER,
+            backin_sites            INTEGER,
+            surface_predominant     TEXT,
+            reservable              INTEGER,
+            full_hookup_sites       INTEGER,
+            electric_hookup_sites   INTEGER,
+            camping_type_confidence TEXT,
+            road_access             TEXT,
+            driveway_surface        TEXT,
+            seasonal_status         TEXT,
+            fire_status             TEXT,
+            elevation_ft            INTEGER,
+            boondock_accessibility  TEXT,
+            city                    TEXT,
+            state_code              TEXT,
+            photo_url               TEXT,
+            tag_mask                INTEGER NOT NULL
+        )
+    """)
+    cur.execute("""
+        INSERT INTO n_search_card
+        SELECT
+            NULL,
+            r.facility_id, r.facility_name, r.org_abbrev, r.camping_type,
+            r.latitude, r.longitude, r.coords_valid,
+            NULL, NULL, NULL, NULL,     -- trig columns, filled below
+            r.total_campsites,
+            r.rv_type_sites, r.sites_accepting_rv, r.sites_accepting_tent,
+            r.walk_in_sites, r.hike_in_sites, r.boat_in_sites,
+            r.equestrian_sites,
+            r.has_full_hookup, r.has_electric_hookup,
+            r.has_water_hookup, r.has_sewer_hookup, r.max_amps,
+            r.max_rv_length, r.pullthrough_sites, r.backin_sites,
+            r.surface_predominant, r.reservable, r.full_hookup_sites,
+            r.electric_hookup_sites, r.camping_type_confidence,
+            c.road_access, c.driveway_surface, c.seasonal_status,
+            c.fire_status, c.elevation_ft, c.boondock_accessibility,
+            fa.city, fa.state_code,
+            p.photo_url,
+            c.tag_mask
+        FROM n_facility_rollup r
+        JOIN n_facility_conditions c ON r.facility_id = c.facility_id
+        {addr_join}
+        LEFT JOIN n_facility_photo p ON r.facility_id = p.facility_id
+        WHERE r.facility_name IS NOT NULL AND r.facility_name <> ''
+          AND r.camping_type IN ({types})
+    """.format(addr_join=db.PREFERRED_ADDRESS_JOIN,
+               types=",".join("'%s'" % t for t in db.DEFAULT_CAMPING_TYPES)))
+
+    # Unit-sphere coordinates for radius search. With these the great-circle
+    # test is a dot product SQLite evaluates natively (see db._proximity_sql)
+    # instead of per-row Python trig callbacks. Computed here in Python so
+    # the build doesn't depend on SQLite's optional math functions.
+    trig = []
+    for card_id, lat, lon in cur.execute(
+            "SELECT card_id, latitude, longitude FROM n_search_card "
+            "WHERE coords_valid = 1").fetchall():
+        phi, lam = math.radians(lat), math.radians(lon)
+        trig.append((math.sin(phi), math.cos(phi),
+                     math.sin(lam), math.cos(lam), card_id))
+    cur.executemany("""
+        UPDATE n_search_card
+        SET sin_lat = ?, cos_lat = ?, sin_lon = ?, cos_lon = ?
+        WHERE card_id = ?
+    """, trig)
+
+    # One index per sort order the app uses: state search and the sitemap
+    # (campsites desc, id tiebreak), the viewport list (same order), and the
+    # state index page (by name). Coordinates are indexed by the R*Tree below.
+    card_indexes = [
+        ("idx_nsc_state_rank",
+         "n_search_card(state_code, total_campsites DESC, facility_id)"),
+        ("idx_nsc_rank", "n_search_card(total_campsites DESC, facility_id)"),
+        ("idx_nsc_state_name", "n_search_card(state_code, facility_name)"),
+    ]
+    for name, defn in card_indexes:
+        cur.execute(f"CREATE INDEX {name} ON {defn}")
+
+    card_count = cur.execute("SELECT COUNT(*) FROM n_search_card").fetchone()[0]
+    print(f"  {card_count:,} searchable facilities")
+
+    # Spatial index over the card table. A composite (latitude, longitude)
+    # B-tree can only range-seek on latitude, so a wide, short viewport
+    # scanned a full latitude band across the continent; the R*Tree seeks on
+    # both axes at once. Points are stored as zero-size boxes keyed by
+    # card_id -- an explicit INTEGER PRIMARY KEY, because VACUUM is free to
+    # renumber implicit rowids and purge_for_deploy.py VACUUMs. Only valid
+    # coordinates go in, so a geo match implies coords_valid = 1.
+    cur.execute("DROP TABLE IF EXISTS n_facility_geo")
+    cur.execute("""
+        CREATE VIRTUAL TABLE n_facility_geo USING rtree(
+            card_id, min_lat, max_lat, min_lon, max_lon
+        )
+    """)
+    cur.execute("""
+        INSERT INTO n_facility_geo
+        SELECT card_id, latitude, latitude, longitude, longitude
+        FROM n_search_card
+        WHERE coords_valid = 1
+    """)
+    geo_count = cur.execute("SELECT COUNT(*) FROM n_facility_geo").fetchone()[0]
+    print(f"  {geo_count:,} in the spatial index")
+
+    # ------------------------------------------------------------------
+    # 6. State cache table
+    # ------------------------------------------------------------------
+    print("\n6. Building state cache...")
 
     cur.execute("DROP TABLE IF EXISTS n_state_cache")
     cur.execute("""
         CREATE TABLE n_state_cache (
             state_code      TEXT PRIMARY KEY,
-            facility_count  INTEGER NOT NULL
+            facility_count  INTEGER NOT NULL,
+            first_page      TEXT
         )
     """)
 
@@ -190,13 +360,98 @@ def main():
     total_fac = cur.execute("SELECT SUM(facility_count) FROM n_state_cache").fetchone()[0]
     print(f"  {state_count} states/territories, {total_fac:,} campable facilities")
 
+    # Each state's unfiltered first page, so picking a state is a lookup
+    # (db.py, "State first pages"). Run by search_by_state over a read
+    # connection, so it is exactly the page the live query would return.
+    conn.commit()
+    read_conn = sqlite3.connect(DB_PATH)
+    read_conn.row_factory = sqlite3.Row
+    codes = [r[0] for r in cur.execute("SELECT state_code FROM n_state_cache")]
+    pages = list(db.state_first_pages(read_conn, codes))
+    read_conn.close()
+    cur.executemany(
+        "UPDATE n_state_cache SET first_page = ? WHERE state_code = ?",
+        [(page, code) for code, page in pages])
+    # Which db.py wrote them (db._stored_first_page ignores them otherwise).
+    cur.execute("""
+        INSERT OR REPLACE INTO n_meta (key, value)
+        VALUES ('state_page_code', ?)
+    """, (db.SOURCE_VERSION,))
+    print(f"  first pages stored for {len(pages)} states")
+
     # ------------------------------------------------------------------
-    # 5. Update metadata
+    # 7. Nearby facilities
+    # ------------------------------------------------------------------
+    # Every facility page lists its nearest neighbours, and the answer only
+    # changes with the data. Computed here by db.nearby_table -- the same
+    # search the page would run -- over its own read connection.
+    print("\n7. Computing nearby facilities...")
+    conn.commit()
+    read_conn = sqlite3.connect(DB_PATH)
+    read_conn.row_factory = sqlite3.Row
+    nearby = list(db.nearby_table(read_conn))
+    read_conn.close()
+
+    cur.execute("DROP TABLE IF EXISTS n_facility_nearby")
+    cur.execute("""
+        CREATE TABLE n_facility_nearby (
+            facility_id TEXT NOT NULL,
+            rank        INTEGER NOT NULL,
+            neighbor_id TEXT NOT NULL,
+            dot         REAL NOT NULL,
+            PRIMARY KEY (facility_id, rank)
+        ) WITHOUT ROWID
+    """)
+    cur.executemany("""
+        INSERT INTO n_facility_nearby (facility_id, rank, neighbor_id, dot)
+        VALUES (?, ?, ?, ?)
+    """, nearby)
+    print(f"  {len(nearby):,} pairs for {len({n[0] for n in nearby}):,} facilities "
+          f"(up to {db.NEARBY_K} within {db.NEARBY_RADIUS_MILES} miles)")
+
+    # ------------------------------------------------------------------
+    # 8. Pin tile pyramid
+    # ------------------------------------------------------------------
+    # The unfiltered map at zooms 3-10 is what every first visit loads.
+    # Render those tiles once here instead of once per worker per tile;
+    # the app serves them from this table and export_tiles.py writes them
+    # out as static files. Rendered by db.get_pin_tile over its own
+    # read connection, so the bytes are exactly what the live endpoint
+    # would produce.
+    print("\n8. Rendering pin tiles...")
+    conn.commit()
+    read_conn = sqlite3.connect(DB_PATH)
+    read_conn.row_factory = sqlite3.Row
+    tiles = list(db.pin_tile_pyramid(read_conn))
+    read_conn.close()
+
+    cur.execute("DROP TABLE IF EXISTS n_pin_tile")
+    cur.execute("""
+        CREATE TABLE n_pin_tile (
+            z       INTEGER NOT NULL,
+            x       INTEGER NOT NULL,
+            y       INTEGER NOT NULL,
+            body    BLOB NOT NULL,
+            PRIMARY KEY (z, x, y)
+        ) WITHOUT ROWID
+    """)
+    cur.executemany("INSERT INTO n_pin_tile (z, x, y, body) VALUES (?, ?, ?, ?)",
+                    tiles)
+    print(f"  {len(tiles):,} tiles, {sum(len(t[3]) for t in tiles):,} bytes "
+          f"(zooms {db.PRERENDERED_TILE_ZOOMS.start}-{db.PRERENDERED_TILE_ZOOMS.stop - 1})")
+
+    # ------------------------------------------------------------------
+    # 9. Update metadata
     # ------------------------------------------------------------------
     cur.execute("""
         INSERT OR REPLACE INTO n_meta (key, value)
         VALUES ('phase4_prep_at', ?)
     """, (ts,))
+    # Which db.py rendered n_pin_tile (db.prerendered_tiles_current).
+    cur.execute("""
+        INSERT OR REPLACE INTO n_meta (key, value)
+        VALUES ('pin_tile_code', ?)
+    """, (db.SOURCE_VERSION,))
 
     conn.commit()
     conn.close()
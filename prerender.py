@@ -0,0 +1,130 @@
+"""Render the crawlable pages to static files for Caddy.
+
+Crawlers are the bulk of the traffic (see /stats), and nearly all of it is
+the ~6,900 facility pages, the state pages, /campgrounds and the sitemap --
+pages that only change with the database and the month. This renders every
+one of them through the app itself (the same routes, templates and bytes
+the app would serve), in parallel across a process pool, and writes each as
+a plain file plus a .gz sidecar:
+
+    OUT_DIR/current -> <build>-<YYYYMM>-<unix time>/
+        facility/<id>.html(.gz)
+        campgrounds.html(.gz)
+        campgrounds/<XX>.html(.gz)
+        sitemap.xml(.gz)
+
+Caddy serves those directly (see README, "Deployment"); gunicorn is left
+with search, the map and the API. A page missing from disk just falls
+through to the app.
+
+A new set is written next to the old one, `current` is switched to it in
+one rename, and other sets are then removed. "Likely open" depends on the
+month, so this runs on every deploy and again at the start of each month.
+
+Usage:
+    python prerender.py OUT_DIR [path-to-db]     # db defaults to ridb.db
+"""
+import gzip
+import os
+import re
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import db
+
+# Pages per task: big enough to amortise the round trip to the pool, small
+# enough that the workers finish together.
+CHUNK = 200
+_SAFE_ID = re.compile(r"[A-Za-z0-9_-]+")
+
+_client = None
+_site_url = None
+
+
+def _init_worker(path):
+    global _client, _site_url
+    db.DB_PATH = path
+    import app
+    _client = app.app.test_client()
+    _site_url = app.SITE_URL
+
+
+def _render(out_dir, paths):
+    """Render paths (site URLs) into out_dir. Returns (pages, bytes)."""
+    pages = size = 0
+    for path, filename in paths:
+        resp = _client.get(path, base_url=_site_url)
+        if resp.status_code != 200:
+            continue
+        body = resp.get_data()
+        target = os.path.join(out_dir, filename)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as f:
+            f.write(body)
+        # mtime=0: the same page always compresses to the same bytes.
+        with open(target + ".gz", "wb") as f:
+            f.write(gzip.compress(body, compresslevel=9, mtime=0))
+        pages += 1
+        size += len(body)
+    return pages, size
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__, file=sys.stderr)
+        return 2
+    out_dir = sys.argv[1]
+    path = sys.argv[2] if len(sys.argv) > 2 else db.DB_PATH
+    db.DB_PATH = path
+    import app
+
+    t0 = time.time()
+    conn = db.get_connection()
+    # Named as the app's data version is (app._data_version).
+    version = f"{db.build_id(conn)}-{datetime.now(app.PST):%Y%m}"
+    pages = [("/campgrounds", "campgrounds.html"),
+             ("/sitemap.xml", "sitemap.xml")]
+    pages += [(f"/campgrounds/{s['state_code']}",
+               f"campgrounds/{s['state_code']}.html")
+              for s in db.get_states(conn)]
+    # RIDB ids are digits; anything else isn't a safe file name, and the
+    # app still serves it.
+    pages += [(f"/facility/{fid}", f"facility/{fid}.html")
+              for fid in db.all_facility_ids(conn) if _SAFE_ID.fullmatch(fid)]
+
+    os.makedirs(out_dir, exist_ok=True)
+    # Timestamped, so a rerun never writes into the set being served.
+    name = f"{version}-{int(t0)}"
+    tmp_dir = os.path.join(out_dir, f".{name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    chunks = [pages[i:i + CHUNK] for i in range(0, len(pages), CHUNK)]
+    with ProcessPoolExecutor(initializer=_init_worker,
+                             initargs=(path,)) as pool:
+        results = list(pool.map(_render, [tmp_dir] * len(chunks), chunks))
+    rendered = sum(n for n, _ in results)
+    size = sum(b for _, b in results)
+
+    final_dir = os.path.join(out_dir, name)
+    os.rename(tmp_dir, final_dir)
+    link = os.path.join(out_dir, "current")
+    tmp_link = link + ".tmp"
+    if os.path.lexists(tmp_link):
+        os.unlink(tmp_link)
+    os.symlink(name, tmp_link)
+    os.replace(tmp_link, link)
+    for other in os.listdir(out_dir):
+        if other not in (name, "current"):
+            target = os.path.join(out_dir, other)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target, ignore_errors=True)
+
+    print(f"{rendered:,} of {len(pages):,} pages ({size / 1e6:.1f} MB) "
+          f"for {version} -> {final_dir} in {time.time() - t0:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -31,7 +31,17 @@ KEEP = {
     "n_facility_conditions",
     "n_facility_tags",
     "n_facility_photo",
+    "n_facility_address",
+    "n_search_card",
+    # R*Tree virtual table plus the shadow tables that hold its nodes;
+    # dropping a shadow table leaves the index unreadable.
+    "n_facility_geo",
+    "n_facility_geo_node",
+    "n_facility_geo_rowid",
+    "n_facility_geo_parent",
     "n_state_cache",
+    "n_facility_nearby",
+    "n_pin_tile",
     "n_meta",
 }
 
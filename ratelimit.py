@@ -0,0 +1,169 @@
+"""
+ratelimit.py — sliding-window rate limiting, per worker or shared
+
+Each client is two counters: hits in the current fixed window and hits in
+the one before it. The sliding count is the current count plus the previous
+one weighted by how much of the previous window still overlaps the last
+`window` seconds. That's constant memory and constant time per hit, where a
+list of timestamps per client had to be filtered and copied on every hit.
+
+Two stores, same arithmetic:
+  - SlidingWindowLimiter keeps the counters in this process, split across
+    sharded locks so concurrent requests rarely wait on each other.
+  - SharedSlidingWindowLimiter keeps them in a small SQLite file that every
+    gunicorn worker opens, so the limit is the limit -- not the limit times
+    the number of workers. Put the file on tmpfs (/dev/shm); it's scratch.
+
+from_env() picks the shared store when FEDCAMP_RATELIMIT_DB names a file.
+No Flask dependency (same pattern as db.py and cache.py).
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+SHARDS = 16
+# Clients per shard before expired ones are swept out. An expired client
+# (no hits for two windows) carries no information, so sweeping loses none.
+# A sweep is a pass over the whole shard, so a shard sweeps at most once a
+# window: more often finds nothing new to expire, and a shard that stays
+# over the size with live clients would otherwise rescan on every hit.
+SHARD_SWEEP_SIZE = 1024
+# Shared store: how often (in hits, per process) expired rows are deleted.
+SHARED_SWEEP_EVERY = 1000
+
+
+def _sliding(limit, window, now, slot, cur, prev):
+    """Apply one hit to a client's counters.
+
+    slot, cur, prev: the client's window number and its counts in that
+    window and the one before (slot None for a new client). Returns
+    (allowed, remaining, retry_after, slot, cur, prev) with the counters
+    as they should be stored -- unchanged past the hit if it was refused.
+    """
+    now_slot = int(now // window)
+    if slot != now_slot:
+        prev = cur if slot == now_slot - 1 else 0
+        cur = 0
+        slot = now_slot
+    elapsed = now - now_slot * window
+    weight = 1.0 - elapsed / window
+    count = prev * weight + cur
+    if count + 1 > limit:
+        # When the count will have fallen enough for one more hit.
+        if cur + 1 <= limit and prev:
+            retry = window * (1.0 - (limit - cur - 1) / prev) - elapsed
+        else:
+            # Not before the next window, and then until this window's
+            # hits have aged out enough.
+            retry = (window - elapsed) + window * max(0.0, 1.0 - (limit - 1) / max(cur, 1))
+        return False, 0, max(retry, 0.0), slot, cur, prev
+    cur += 1
+    return True, max(0, int(limit - count - 1)), 0, slot, cur, prev
+
+
+class SlidingWindowLimiter:
+    """At most `limit` hits per key in any `window` seconds, approximately.
+
+    hit(key) -> (allowed, remaining, retry_after).
+    """
+
+    def __init__(self, limit, window, shards=SHARDS):
+        self.limit = limit
+        self.window = window
+        # Per shard: clients, its lock, and when it may next be swept.
+        self._shards = [[{}, threading.Lock(), 0.0] for _ in range(shards)]
+
+    def hit(self, key):
+        now = time.monotonic()
+        shard = self._shards[hash(key) % len(self._shards)]
+        clients, lock = shard[0], shard[1]
+        with lock:
+            slot, cur, prev = clients.get(key, (None, 0, 0))
+            allowed, remaining, retry, slot, cur, prev = _sliding(
+                self.limit, self.window, now, slot, cur, prev)
+            clients[key] = (slot, cur, prev)
+            if len(clients) > SHARD_SWEEP_SIZE and now >= shard[2]:
+                shard[2] = now + self.window
+                live = int(now // self.window) - 1
+                for k in [k for k, v in clients.items() if v[0] < live]:
+                    del clients[k]
+        return allowed, remaining, retry
+
+
+class SharedSlidingWindowLimiter:
+    """SlidingWindowLimiter whose counters live in a SQLite file shared by
+    every process that opens it.
+
+    Wall-clock time, since monotonic clocks aren't comparable across
+    processes. One short write transaction per hit; durability is off --
+    after a crash the counts are simply gone, which is fine for a limiter.
+    If the file can't be used (locked too long, disk trouble) the hit is
+    counted in a per-process fallback instead: degraded, never failing
+    requests.
+    """
+
+    def __init__(self, path, limit, window):
+        self.path = path
+        self.limit = limit
+        self.window = window
+        self._local = threading.local()
+        self._hits = 0
+        self._fallback = SlidingWindowLimiter(limit, window)
+
+    def _connection(self):
+        # Per thread and per process: a connection must not cross a fork.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=0.05,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS rate_limit (
+                    key     TEXT PRIMARY KEY,
+                    slot    INTEGER NOT NULL,
+                    cur     INTEGER NOT NULL,
+                    prev    INTEGER NOT NULL
+                ) WITHOUT ROWID
+            """)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def hit(self, key):
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT slot, cur, prev FROM rate_limit WHERE key = ?",
+                    (key,)).fetchone()
+                slot, cur, prev = row if row else (None, 0, 0)
+                allowed, remaining, retry, slot, cur, prev = _sliding(
+                    self.limit, self.window, now, slot, cur, prev)
+                if allowed:
+                    conn.execute("""
+                        INSERT OR REPLACE INTO rate_limit (key, slot, cur, prev)
+                        VALUES (?, ?, ?, ?)
+                    """, (key, slot, cur, prev))
+                self._hits += 1
+                if self._hits % SHARED_SWEEP_EVERY == 0:
+                    conn.execute("DELETE FROM rate_limit WHERE slot < ?",
+                                 (int(now // self.window) - 1,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error:
+            return self._fallback.hit(key)
+        return allowed, remaining, retry
+
+
+def from_env(limit, window):
+    """The shared limiter if FEDCAMP_RATELIMIT_DB is set, else per process."""
+    path = os.environ.get("FEDCAMP_RATELIMIT_DB")
+    if path:
+        return SharedSlidingWindowLimiter(path, limit, window)
+    return SlidingWindowLimiter(limit, window)
@@ -5,6 +5,12 @@ state must return that many campgrounds. Keeping them honest means deriving
 them from the same rules search uses — the preferred-address join, the
 facility_name filter, and the default camping types.
 
+Each row also stores the state's first page of results with no filters
+(db.state_first_pages), computed by the search code that is shipping, and
+n_meta records which db.py that was. The app only serves the stored pages
+while its db.py is the same one, and runs the query otherwise, so a code
+deploy that skips this script costs speed, not correctness.
+
 Safe to re-run: the table is dropped and rebuilt from the facility data, and
 it is a ~50-row derived cache with no independent state of its own.
 
@@ -46,16 +52,27 @@ def main():
         conn.close()
         return 1
 
+    read_conn = sqlite3.connect(path)
+    read_conn.row_factory = sqlite3.Row
+    pages = dict(db.state_first_pages(read_conn, [code for code, _ in rows]))
+    read_conn.close()
+
     cur.execute("DROP TABLE IF EXISTS n_state_cache")
     cur.execute("""
         CREATE TABLE n_state_cache (
             state_code      TEXT PRIMARY KEY,
-            facility_count  INTEGER NOT NULL
+            facility_count  INTEGER NOT NULL,
+            first_page      TEXT
         )
     """)
-    cur.executemany(
-        "INSERT INTO n_state_cache (state_code, facility_count) VALUES (?, ?)",
-        rows)
+    cur.executemany("""
+        INSERT INTO n_state_cache (state_code, facility_count, first_page)
+        VALUES (?, ?, ?)
+    """, [(code, count, pages[code]) for code, count in rows])
+    cur.execute("""
+        INSERT OR REPLACE INTO n_meta (key, value)
+        VALUES ('state_page_code', ?)
+    """, (db.SOURCE_VERSION,))
     conn.commit()
 
     after = cur.execute(
@@ -299,15 +299,19 @@
         disableClusteringAtZoom: 11,
         spiderfyOnMaxZoom: true,
         iconCreateFunction: function(cluster) {
-            var n = cluster.getChildCount();
-            var size = n < 10 ? 'sm' : (n < 100 ? 'md' : 'lg');
-            return L.divIcon({
-                html: '<div><span>' + n + '</span></div>',
-                className: 'campdex-cluster campdex-cluster-' + size,
-                iconSize: L.point(40, 40)
-            });
+            return clusterIcon(cluster.getChildCount());
         }
     }).addTo(map);
+    // Zoomed out, server-clustered tiles are drawn here instead (below).
+    var clusterLayer = L.layerGroup().addTo(map);
+    function clusterIcon(n) {
+        var size = n < 10 ? 'sm' : (n < 100 ? 'md' : 'lg');
+        return L.divIcon({
+            html: '<div><span>' + n + '</span></div>',
+            className: 'campdex-cluster campdex-cluster-' + size,
+            iconSize: L.point(40, 40)
+        });
+    }
     var currentRequest = null;
     var markersById = {};     // facility_id -> marker, rebuilt on every pin load
     var loadedBounds = null;  // bounds of the last pin fetch
@@ -345,14 +349,36 @@
         return d.innerHTML;
     }
 
-    // rvParam differs per endpoint: /api/pins takes min_rv_length,
-    // /search takes rv_length.
-    function buildQuery(rvParam) {
+    // The viewport as the server sees it: edges rounded to 4 places. The
+    // list is filtered on exactly this box, so the pin count is too.
+    function viewBox() {
         var b = map.getBounds();
-        var params = 'south=' + b.getSouth().toFixed(4)
-            + '&north=' + b.getNorth().toFixed(4)
-            + '&west=' + b.getWest().toFixed(4)
-            + '&east=' + b.getEast().toFixed(4);
+        return [+b.getSouth().toFixed(4), +b.getNorth().toFixed(4),
+                +b.getWest().toFixed(4), +b.getEast().toFixed(4)];
+    }
+
+    // Round a box outward onto the /api/pins cache grid, so nearby pans
+    // share one cached response. Must match _snap_bounds in app.py
+    // operation for operation; String() round-trips the exact doubles.
+    var PIN_GRID_MIN_CELL = 360 / 1048576;
+    function snapBounds(box) {
+        for (var i = 0; i < 16; i++) {
+            var span = Math.max(box[1] - box[0], box[3] - box[2]);
+            var cell = 360;
+            while (cell > span / 8 && cell > PIN_GRID_MIN_CELL) cell /= 2;
+            var snapped = [Math.floor(box[0] / cell) * cell, Math.ceil(box[1] / cell) * cell,
+                           Math.floor(box[2] / cell) * cell, Math.ceil(box[3] / cell) * cell];
+            if (snapped.every(function(v, j) { return v === box[j]; })) break;
+            box = snapped;
+        }
+        return box;
+    }
+
+    // The filter half of a query string, with a leading '&'. rvParam
+    // differs per endpoint: /api/pins takes min_rv_length, /search takes
+    // rv_length.
+    function filterQuery(rvParam) {
+        var params = '';
         filters.camping_types.forEach(function(v) { params += '&camping_type=' + v; });
         filters.agencies.forEach(function(v) { params += '&agency=' + v; });
         // Tri-state: include -> param, exclude -> not_param (the same
@@ -369,59 +395,193 @@
         return params;
     }
 
-    function loadPins() {
-        if (currentRequest) { currentRequest.abort(); currentRequest = null; }
+    // Bounds + filters. box defaults to the viewport.
+    function buildQuery(rvParam, box) {
+        box = box || viewBox();
+        return 'south=' + String(box[0])
+            + '&north=' + String(box[1])
+            + '&west=' + String(box[2])
+            + '&east=' + String(box[3])
+            + filterQuery(rvParam);
+    }
 
-        var query = buildQuery('min_rv_length');
-        loadedBounds = map.getBounds();
-        status.update('Loading…');
+    // Called once the new pins are in hand, so a failed or aborted load
+    // leaves the old ones on the map.
+    function clearPins() {
+        clearMarkerActive();       // the marker it points at is going away
+        pinLayer.clearLayers();
+        clusterLayer.clearLayers();
+        markersById = {};
+    }
 
-        var controller = new AbortController();
-        currentRequest = controller;
+    function pinMarker(p) {
+        var marker = L.marker([p.latitude, p.longitude], {
+            icon: pinIcon(campingColor(p.camping_type, p.seasonal_status)),
+            bubblingMouseEvents: false
+        });
+        markersById[p.facility_id] = marker;
+
+        var tgt = ('ontouchstart' in window) ? '' : ' target="_blank" rel="noopener"';
+        var html = '<strong><a href="/facility/' + p.facility_id + '"' + tgt + '>'
+            + escapeHtml(p.facility_name) + '</a></strong>';
+        if (p.total_campsites) html += '<br>' + p.total_campsites + ' sites';
+        if (p.org_abbrev) html += ' &middot; ' + p.org_abbrev;
+        if (p.max_rv_length) html += '<br>Max RV: ' + p.max_rv_length + ' ft';
+        if (p.seasonal_status === 'PERMANENTLY_CLOSED') html += '<br><em>Permanently Closed</em>';
+        else if (p.seasonal_status === 'TEMPORARILY_CLOSED') html += '<br><em>Temporarily Closed</em>';
+        else if (p.seasonal_status === 'WINTER_CLOSURE') html += '<br><em>Winter Closure</em>';
+        else if (p.seasonal_status === 'SEASONAL_CLOSURE') html += '<br><em>Seasonal</em>';
+        // Auto-pan clear of the floating chip row (top) and the
+        // status pill / attribution (bottom), which the default
+        // padding knows nothing about.
+        marker.bindPopup(html, {
+            autoPanPaddingTopLeft: L.point(16, 88),
+            autoPanPaddingBottomRight: L.point(16, 48)
+        });
+        marker.bindTooltip(escapeHtml(p.facility_name));
+        // Pin -> card hover link. setCardActive no-ops when the
+        // facility isn't in the loaded pages (never fetches).
+        marker.on('mouseover', function() { setCardActive(p.facility_id); });
+        marker.on('mouseout', function() { clearCardActive(); });
+        return marker;
+    }
 
-        fetch('/api/pins?' + query, {signal: controller.signal})
+    // A server cluster (see tiles below). Clicking zooms to its members
+    // and reloads, since the clusters on screen were cut for this zoom.
+    function serverClusterMarker(c) {
+        var marker = L.marker([c.latitude, c.longitude], {
+            icon: clusterIcon(c.count),
+            bubblingMouseEvents: false
+        });
+        marker.on('click', function() {
+            refreshOnMoveEnd = true;
+            map.fitBounds([[c.south, c.west], [c.north, c.east]],
+                          {padding: [40, 40], maxZoom: CLUSTER_MAX_ZOOM + 1});
+        });
+        return marker;
+    }
+
+    // Reverse of db.pins_to_columns: parallel arrays back to pin objects.
+    function decodePins(c) {
+        var pins = new Array(c.n);
+        var lat = 0, lon = 0;
+        for (var i = 0; i < c.n; i++) {
+            lat += c.latitude[i];
+            lon += c.longitude[i];
+            pins[i] = {
+                facility_id: c.facility_id[i],
+                facility_name: c.facility_name[i],
+                latitude: lat / c.scale,
+                longitude: lon / c.scale,
+                camping_type: c.dict.camping_type[c.camping_type[i]],
+                total_campsites: c.total_campsites[i],
+                org_abbrev: c.dict.org_abbrev[c.org_abbrev[i]],
+                max_rv_length: c.max_rv_length[i],
+                seasonal_status: c.dict.seasonal_status[c.seasonal_status[i]]
+            };
+        }
+        return pins;
+    }
+
+    // The viewport's pins, unclustered, from /api/pins. Resolves to the
+    // number inside the viewport.
+    function loadViewportPins(view, signal) {
+        return fetch('/api/pins?' + buildQuery('min_rv_length', snapBounds(view)) + '&format=columns',
+                     {signal: signal})
             .then(function(r) { return r.json(); })
+            .then(decodePins)
             .then(function(pins) {
-                currentRequest = null;
-                clearMarkerActive();       // the marker it points at is going away
-                pinLayer.clearLayers();
-                markersById = {};
+                clearPins();
                 var markers = [];
+                var inView = 0;   // the snapped box returns pins past the edges
                 pins.forEach(function(p) {
-                    var marker = L.marker([p.latitude, p.longitude], {
-                        icon: pinIcon(campingColor(p.camping_type, p.seasonal_status)),
-                        bubblingMouseEvents: false
-                    });
-                    markers.push(marker);
-                    markersById[p.facility_id] = marker;
-
-                    var tgt = ('ontouchstart' in window) ? '' : ' target="_blank" rel="noopener"';
-                    var html = '<strong><a href="/facility/' + p.facility_id + '"' + tgt + '>'
-                        + escapeHtml(p.facility_name) + '</a></strong>';
-                    if (p.total_campsites) html += '<br>' + p.total_campsites + ' sites';
-                    if (p.org_abbrev) html += ' &middot; ' + p.org_abbrev;
-                    if (p.max_rv_length) html += '<br>Max RV: ' + p.max_rv_length + ' ft';
-                    if (p.seasonal_status === 'PERMANENTLY_CLOSED') html += '<br><em>Permanently Closed</em>';
-                    else if (p.seasonal_status === 'TEMPORARILY_CLOSED') html += '<br><em>Temporarily Closed</em>';
-                    else if (p.seasonal_status === 'WINTER_CLOSURE') html += '<br><em>Winter Closure</em>';
-                    else if (p.seasonal_status === 'SEASONAL_CLOSURE') html += '<br><em>Seasonal</em>';
-                    // Auto-pan clear of the floating chip row (top) and the
-                    // status pill / attribution (bottom), which the default
-                    // padding knows nothing about.
-                    marker.bindPopup(html, {
-                        autoPanPaddingTopLeft: L.point(16, 88),
-                        autoPanPaddingBottomRight: L.point(16, 48)
-                    });
-                    marker.bindTooltip(escapeHtml(p.facility_name));
-                    // Pin -> card hover link. setCardActive no-ops when the
-                    // facility isn't in the loaded pages (never fetches).
-                    marker.on('mouseover', function() { setCardActive(p.facility_id); });
-                    marker.on('mouseout', function() { clearCardActive(); });
+                    if (p.latitude >= view[0] && p.latitude <= view[1]
+                            && p.longitude >= view[2] && p.longitude <= view[3]) inView++;
+                    markers.push(pinMarker(p));
                 });
                 // One bulk add is far cheaper than addTo() per marker.
                 pinLayer.addLayers(markers);
-                var n = pins.length.toLocaleString();
-                status.update('<strong>' + n + '</strong> campground' + (pins.length === 1 ? '' : 's') + ' in view');
+                return inView;
+            });
+    }
+
+    // ---------------------------------------------------------------
+    // Pin tiles. Zoomed out, the map draws /api/pins/z/x/y tiles, which
+    // the server has already clustered, instead of shipping every pin in
+    // a continental view for the browser to cluster. Tile URLs carry the
+    // database build, so they're immutable: panning back over a region,
+    // or another visitor loading it, never reaches the app. Clusters
+    // can't be counted against the viewport edge, so the pill count comes
+    // from /api/pins/count. Must agree with db.CLUSTER_MAX_ZOOM.
+    // ---------------------------------------------------------------
+    var CLUSTER_MAX_ZOOM = 10;
+    var pinsBuild = document.getElementById('state-map').dataset.build || '';
+    var refreshOnMoveEnd = false;
+
+    function tileRange(view, z) {
+        var n = Math.pow(2, z);
+        function tx(lon) { return Math.floor((lon + 180) / 360 * n); }
+        function ty(lat) {
+            lat = Math.max(-85.0511287798066, Math.min(85.0511287798066, lat));
+            var s = Math.sin(lat * Math.PI / 180);
+            return Math.floor((0.5 - Math.log((1 + s) / (1 - s)) / (4 * Math.PI)) * n);
+        }
+        function clamp(v) { return Math.max(0, Math.min(n - 1, v)); }
+        return {x0: clamp(tx(view[2])), x1: clamp(tx(view[3])),
+                y0: clamp(ty(view[1])), y1: clamp(ty(view[0]))};
+    }
+
+    // Unfiltered tiles come from /tiles/<version>/..., a plain path that Caddy
+    // serves from disk (prerendered at build time); filtered ones from
+    // /api/pins/z/x/y.
+    function tileUrl(z, x, y, query) {
+        if (!query && pinsBuild)
+            return '/tiles/' + encodeURIComponent(pinsBuild) + '/' + z + '/' + x + '/' + y + '.json';
+        return '/api/pins/' + z + '/' + x + '/' + y + '?b=' + encodeURIComponent(pinsBuild) + query;
+    }
+
+    function loadTilePins(view, z, signal) {
+        var query = filterQuery('min_rv_length');
+        var range = tileRange(view, z);
+        var requests = [];
+        for (var x = range.x0; x <= range.x1; x++) {
+            for (var y = range.y0; y <= range.y1; y++) {
+                requests.push(fetch(tileUrl(z, x, y, query), {signal: signal})
+                    .then(function(r) { return r.json(); }));
+            }
+        }
+        var count = fetch('/api/pins/count?' + buildQuery('min_rv_length', view), {signal: signal})
+            .then(function(r) { return r.json(); });
+        return Promise.all([count, Promise.all(requests)]).then(function(res) {
+            clearPins();
+            res[1].forEach(function(features) {
+                features.forEach(function(f) {
+                    clusterLayer.addLayer(f.count ? serverClusterMarker(f) : pinMarker(f));
+                });
+            });
+            return res[0].count;
+        });
+    }
+
+    function loadPins() {
+        if (currentRequest) { currentRequest.abort(); currentRequest = null; }
+
+        var view = viewBox();
+        var zoom = map.getZoom();
+        loadedBounds = map.getBounds();
+        status.update('Loading…');
+
+        var controller = new AbortController();
+        currentRequest = controller;
+
+        var loading = zoom <= CLUSTER_MAX_ZOOM
+            ? loadTilePins(view, zoom, controller.signal)
+            : loadViewportPins(view, controller.signal);
+        loading
+            .then(function(inView) {
+                currentRequest = null;
+                var n = inView.toLocaleString();
+                status.update('<strong>' + n + '</strong> campground' + (inView === 1 ? '' : 's') + ' in view');
                 document.getElementById('mf-apply-n').textContent = n;
                 // Until the panel has fetched (it's lazy on mobile), the pin
                 // count is the best number for the List button.
@@ -634,6 +794,11 @@
 
     map.on('moveend', function() {
         writeUrl();   // replaceState: the URL mirrors the viewport, no history entries
+        if (refreshOnMoveEnd) {   // a server cluster was clicked
+            refreshOnMoveEnd = false;
+            requestRefresh();
+            return;
+        }
         if (boundsMoved()) searchAreaBtn.removeAttribute('hidden');
         else searchAreaBtn.setAttribute('hidden', '');
     });